@@ -0,0 +1,195 @@
+"""
+Tokenises a sentence-per-line corpus once and caches it as integer IDs.
+
+The cache of a corpus foo.txt consists of
+
+    * foo.txt.ids.npy: the lowercased tokens of the whole corpus as a uint32
+        array of word IDs, opened with mmap,
+    * foo.txt.ids-words.npz: the word table, saved as an embedding_io
+        vocabulary sidecar, and
+    * foo.txt.ids.npz: the corpus frequency and the document (sentence)
+        frequency of each word, the sentence offsets into the ID array, and
+        the size and mtime of foo.txt; the cache is rebuilt if these do not
+        match the corpus.
+
+The corpus is split into line-aligned byte ranges that are encoded with
+local word tables by worker processes; the shards are mapped to the global
+word table and appended in order.
+"""
+
+import logging
+from multiprocessing import cpu_count, Pool
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from embedding_io import (imap_bounded, line_aligned_ranges,
+                          read_vocab_sidecar, source_stamp,
+                          write_vocab_sidecar)
+
+
+def cache_paths(corpus):
+    return ('{}.ids.npy'.format(corpus), '{}.ids.npz'.format(corpus),
+            '{}.ids-words.npz'.format(corpus))
+
+
+def encode_range(task):
+    """
+    Encodes the lines in a byte range of the corpus with a local word table.
+    Returns the table, the token IDs, the sentence lengths and the corpus and
+    document frequencies of the words in the table.
+    """
+    corpus, start, end = task
+    with open(corpus) as inf:
+        inf.seek(start)
+        data = inf.read(end - start)
+    lines = data.lower().split('\n')
+    if data.endswith('\n'):
+        lines.pop()
+    index = {}
+    ids, lengths = [], []
+    for line in lines:
+        tokens = line.split()
+        lengths.append(len(tokens))
+        ids.extend([index.setdefault(token, len(index)) for token in tokens])
+    words = [None] * len(index)
+    for word, i in index.iteritems():
+        words[i] = word
+    ids = np.array(ids, dtype=np.uint32)
+    lengths = np.array(lengths, dtype=np.int64)
+    counts = np.bincount(ids, minlength=len(words))
+    sentences = np.repeat(np.arange(len(lengths)), lengths)
+    pairs = np.unique(sentences * len(words) + ids)
+    doc_freqs = np.bincount(pairs % len(words) if len(words) else pairs,
+                            minlength=len(words))
+    return words, ids, lengths, counts, doc_freqs
+
+
+def accumulate(totals, gids, values, size):
+    """Adds values to totals[gids], growing totals to size first."""
+    totals = np.concatenate([totals, np.zeros(size - len(totals), np.int64)])
+    totals[gids] += values
+    return totals
+
+
+def build_cache(corpus, processes=None, chunk_bytes=1 << 26):
+    """Encodes the corpus and writes its cache; returns the EncodedCorpus."""
+    logging.info('encoding {} ...'.format(corpus))
+    ids_fn, meta_fn, words_fn = cache_paths(corpus)
+    stamp = source_stamp(corpus)
+    tasks = [(corpus, start, end) for start, end in
+             line_aligned_ranges(corpus, chunk_bytes, header=False)]
+    processes = min(processes or cpu_count(), max(len(tasks), 1))
+    pool = Pool(processes)
+    index, words = {}, []
+    counts = np.zeros(0, np.int64)
+    doc_freqs = np.zeros(0, np.int64)
+    lengths = []
+    began = time.time()
+    tokens = 0
+    # at most 2 * processes encoded shards wait for the parent
+    shards = imap_bounded(pool, encode_range, tasks, 2 * processes)
+    with open(ids_fn + '.raw', 'wb') as rawf:
+        for i, (local_words, ids, local_lengths, local_counts,
+                local_doc_freqs) in enumerate(shards):
+            gids = np.empty(len(local_words), dtype=np.uint32)
+            for j, word in enumerate(local_words):
+                gid = index.get(word)
+                if gid is None:
+                    gid = index[word] = len(words)
+                    words.append(word)
+                gids[j] = gid
+            gids[ids].tofile(rawf)
+            counts = accumulate(counts, gids, local_counts, len(words))
+            doc_freqs = accumulate(doc_freqs, gids, local_doc_freqs,
+                                   len(words))
+            lengths.append(local_lengths)
+            tokens += len(ids)
+            logging.info('{}/{} shards, {:,} tokens encoded ({:,.0f} '
+                         'tokens/s)'.format(i + 1, len(tasks), tokens,
+                                            tokens / (time.time() - began)))
+    pool.close()
+    pool.join()
+
+    if tokens:
+        ids = np.memmap(ids_fn + '.raw', dtype=np.uint32, mode='r')
+    else:
+        ids = np.zeros(0, dtype=np.uint32)
+    with open(ids_fn + '.tmp', 'wb') as outf:
+        np.save(outf, ids)
+    del ids
+    os.remove(ids_fn + '.raw')
+    os.rename(ids_fn + '.tmp', ids_fn)
+
+    offsets = np.zeros(sum(len(l) for l in lengths) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    write_vocab_sidecar(corpus, words, header=False, vocab_fn=words_fn)
+    # written last: the cache is only valid once this exists
+    with open(meta_fn + '.tmp', 'wb') as outf:
+        np.savez(outf, counts=counts, doc_freqs=doc_freqs, offsets=offsets,
+                 stamp=stamp)
+    os.rename(meta_fn + '.tmp', meta_fn)
+    return EncodedCorpus(words, np.load(ids_fn, mmap_mode='r'), offsets,
+                         counts, doc_freqs)
+
+
+def load_corpus(corpus, processes=None):
+    """
+    Returns the EncodedCorpus of corpus, encoding it on the first call (with
+    processes worker processes, all cores by default).
+    """
+    ids_fn, meta_fn, words_fn = cache_paths(corpus)
+    words = read_vocab_sidecar(corpus, header=False, vocab_fn=words_fn)
+    if (words is not None and os.path.isfile(ids_fn) and
+            os.path.isfile(meta_fn)):
+        meta = np.load(meta_fn)
+        if (np.array_equal(meta['stamp'], source_stamp(corpus)) and
+                len(meta['counts']) == len(words)):
+            logging.info('loading encoded corpus from {}'.format(ids_fn))
+            return EncodedCorpus(words, np.load(ids_fn, mmap_mode='r'),
+                                 meta['offsets'], meta['counts'],
+                                 meta['doc_freqs'])
+        logging.info('{} is stale'.format(meta_fn))
+    return build_cache(corpus, processes)
+
+
+class EncodedCorpus():
+    """
+    A corpus as word IDs: the tokens of the i-th sentence are
+    words[ids[offsets[i]:offsets[i + 1]]].
+    """
+    def __init__(self, words, ids, offsets, counts, doc_freqs):
+        self.words = words
+        self.ids = ids
+        self.offsets = offsets
+        self.counts = counts
+        self.doc_freqs = doc_freqs
+
+    def __len__(self):
+        """The number of sentences."""
+        return len(self.offsets) - 1
+
+    def word_ids(self, words):
+        """The IDs of words (-1 for words not in the corpus)."""
+        index = {word: i for i, word in enumerate(self.words)}
+        return np.array([index.get(word, -1) for word in words],
+                        dtype=np.int64)
+
+    def sentence_blocks(self, block_tokens=1 << 24):
+        """
+        Yields (first, last) sentence ranges of about block_tokens tokens, so
+        that the ID array can be processed in bounded memory.
+        """
+        first = 0
+        while first < len(self):
+            last = np.searchsorted(self.offsets,
+                                   self.offsets[first] + block_tokens,
+                                   side='right') - 1
+            last = min(max(last, first + 1), len(self))
+            yield first, last
+            first = last
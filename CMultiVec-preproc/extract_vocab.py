@@ -1,17 +1,30 @@
 import argparse
-from collections import Counter
 import logging
+from multiprocessing import cpu_count
 import os
+import sys
+
+import numpy as np
+
+from corpus_ids import load_corpus
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from embedding_io import scan_vocab
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Extracts the vocabulary from the corpus.')
     parser.add_argument('corpus', help='sentence/document per line')
-    parser.add_argument('init_embed', help='vectors in w2v format')
+    parser.add_argument('init_embed', help='vectors in w2v format (binary if '
+                                           'the name ends with .bin)')
     # w2v embeddings contain words in freq order (that may != idf ord)
     parser.add_argument('vocab_out')
     parser.add_argument('--cutoff', type=int, default=199999)
+    parser.add_argument('--processes', '-p', type=int, default=cpu_count(),
+                        help='the number of processes encoding the corpus '
+                             'shards if it is not cached (all cores by '
+                             'default)')
 
     args = parser.parse_args()
     if os.path.isfile(args.vocab_out):
@@ -29,28 +42,29 @@ def get_logger():
     return logger
 
 
+def read_embedded_words(init_embed, processes=None):
+    """
+    The lowercased words of a w2v file; only the first column is read, and
+    it is cached in the vocabulary sidecar of the file.
+    """
+    return {word.lower() for word in scan_vocab(init_embed,
+                                                processes=processes)}
+
+
 if __name__ == '__main__':
     logger = get_logger()
     args = parse_args()
     logger.info('Counting words...')
-    word_freqs = Counter()
-    with open(args.corpus) as inf:
-        for i, line in enumerate(inf):
-            if i % 1000000 == 0 and i > 0:
-                logger.info('{:,} sentences read'.format(i))
-            word_freqs.update(line.strip().lower().split())
+    corpus = load_corpus(args.corpus, args.processes)
 
     logger.info('Reading embedded words...')
-    with open(args.init_embed) as inf:
-        inf.readline()  # Header
-        embed_set = {line.strip().split(' ', 1)[0].lower()
-                     for line in inf.readlines()}
+    embed_set = read_embedded_words(args.init_embed, args.processes)
 
     logger.info('Assembling list...')
     vocab = ['UUUNKKK']
-    for word, _ in word_freqs.most_common():
-        if word in embed_set:
-            vocab.append(word)
+    for i in np.argsort(-corpus.counts, kind='mergesort'):
+        if corpus.words[i] in embed_set:
+            vocab.append(corpus.words[i])
 
     logger.info('Writing vocabulary...')
     with open(args.vocab_out, 'w') as outf:
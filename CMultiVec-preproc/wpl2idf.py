@@ -1,20 +1,33 @@
 import argparse
-from collections import Counter
 import logging
-from math import log
+from multiprocessing import cpu_count
 import os
+import sys
+
+import numpy as np
+
+from corpus_ids import load_corpus
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from embedding_io import iter_parsed_chunks
+from w2v_binary import read_w2v_binary
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Prepare input files for CMultiVec form a corpus.')
     parser.add_argument('corpus', help='sentence/document per line')
-    parser.add_argument('init_embed', help='vectors in w2v format')
+    parser.add_argument('init_embed', help='vectors in w2v format (binary if '
+                                           'the name ends with .bin)')
     # w2v embeddings contain words in freq order (that may != idf ord)
     parser.add_argument('vocab', help='vocabulary list (see extract_vocab.py)')
     parser.add_argument('corpus_out', help='the corpus output file')
     parser.add_argument('embed_out', help='the output embedding file')
     parser.add_argument('idf_out', help='the idf output file')
+    parser.add_argument('--processes', '-p', type=int, default=cpu_count(),
+                        help='the number of processes encoding the corpus '
+                             'shards if it is not cached and parsing the '
+                             'embedding (all cores by default)')
 
     args = parser.parse_args()
     for out_fn in [args.corpus_out, args.embed_out, args.idf_out]:
@@ -33,10 +46,84 @@ def get_logger():
     return logger
 
 
+def format_vector(vec):
+    return ' '.join(str(f) for f in vec.tolist())
+
+
+def filter_embedding(init_embed, vocab_set, logger, processes=None):
+    """
+    Returns the vector strings of the words in vocab_set and the mean of all
+    other vectors. A lowercase word takes the vector of its last occurrence;
+    otherwise a word takes the vector of its first uppercase variant. All
+    other rows (including a literal UUUNKKK) go into the UNK centroid. The
+    vectors are parsed as float64 and written with str, like the centroid.
+    """
+    if init_embed.endswith('.bin'):
+        blocks = [read_w2v_binary(init_embed)]
+    else:
+        blocks = iter_parsed_chunks(init_embed, processes=processes,
+                                    dtype='float64')
+    vocab_arr = np.array(sorted(vocab_set - {'UUUNKKK'}))
+    embed = {}
+    unk_sum, unks = None, 0
+    for words, vecs in blocks:
+        if not words:
+            continue
+        words = np.array(words)
+        lowers = np.char.lower(words)
+        exact = np.in1d(words, vocab_arr)
+        known = np.in1d(lowers, vocab_arr)
+        _, firsts = np.unique(lowers, return_index=True)
+        first = np.zeros(len(words), dtype=bool)
+        first[firsts] = True
+        first &= known & ~exact
+        first[first] = [wl not in embed for wl in lowers[first]]
+        unk = ~(exact | first)
+        if unk_sum is None:
+            unk_sum = np.zeros(vecs.shape[1])
+        unk_sum += vecs[unk].sum(axis=0)
+        unks += unk.sum()
+        for i in np.flatnonzero(~unk):
+            embed[lowers[i]] = format_vector(vecs[i])
+        logger.info('{:,} embedded words kept, {:,} unknown'.format(
+            len(embed), unks))
+    embed['UUUNKKK'] = format_vector(unk_sum / max(unks, 1))
+    return embed
+
+
+def write_corpus(corpus, lut, out_words, outf, logger):
+    """
+    Writes the corpus one word per line, with each sentence closed by an
+    oooeddd line; the words are out_words[lut[id]]. Returns the number of
+    sentences that contain out_words[-1] (UUUNKKK).
+    """
+    out_words = np.array(out_words + ['oooeddd', ''], dtype=object)
+    unk, marker, empty = len(out_words) - 3, len(out_words) - 2, \
+        len(out_words) - 1
+    unk_sents = 0
+    for first, last in corpus.sentence_blocks():
+        starts = corpus.offsets[first:last] - corpus.offsets[first]
+        lengths = np.diff(corpus.offsets[first:last + 1])
+        tokens = lut[corpus.ids[corpus.offsets[first]:corpus.offsets[last]]]
+        sents = np.repeat(np.arange(first, last), lengths)
+        unk_sents += len(np.unique(sents[tokens == unk]))
+        # an empty sentence is an empty line followed by the marker
+        seg_lengths = lengths + 1 + (lengths == 0)
+        seg_starts = np.cumsum(seg_lengths) - seg_lengths
+        out = np.empty(seg_lengths.sum(), dtype=np.int64)
+        out.fill(marker)
+        out[np.arange(len(tokens)) +
+            np.repeat(seg_starts - starts, lengths)] = tokens
+        out[seg_starts[lengths == 0]] = empty
+        outf.write('\n'.join(out_words[out].tolist()))
+        outf.write('\n')
+        logger.info('{:,} sentences written'.format(last))
+    return unk_sents
+
+
 def main():
     logger = get_logger()
     args = parse_args()
-    d_freq = Counter()
 
     logger.info('Reading vocab file...')
     with open(args.vocab) as inf:
@@ -44,46 +131,29 @@ def main():
         vocab_set = set(vocab)
 
     logger.info('Processing corpus...')
-    with open(args.corpus) as cinf, open(args.corpus_out, 'w') as coutf:
-        for n_sent, line in enumerate(cinf):
-            if n_sent % 1000000 == 0 and n_sent > 0:
-                logger.info('{:,} sentences read'.format(n_sent))
-            words = [w if w in vocab_set else 'UUUNKKK'
-                     for w in line.strip().lower().split()]
-            d_freq.update(set(words))
-            coutf.write("\n".join(words))
-            coutf.write("\noooeddd\n")
+    corpus = load_corpus(args.corpus, args.processes)
+    n_sent = len(corpus) - 1  # the index of the last sentence
+    out_words = [word for word in vocab if word != 'UUUNKKK'] + ['UUUNKKK']
+    lut = np.empty(len(corpus.words), dtype=np.int64)
+    lut.fill(len(out_words) - 1)
+    ids = corpus.word_ids(out_words[:-1])
+    lut[ids[ids >= 0]] = np.flatnonzero(ids >= 0)
+    with open(args.corpus_out, 'w') as coutf:
+        unk_sents = write_corpus(corpus, lut, out_words, coutf, logger)
 
     logger.info('Writing idfs...')
+    d_freq = dict(zip(out_words[:-1], np.where(
+        ids >= 0, corpus.doc_freqs[ids], 0).tolist()))
+    d_freq['UUUNKKK'] = unk_sents
+    doc_freqs = np.array([d_freq[word] for word in vocab], dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        idfs = np.log(1 + float(n_sent) / doc_freqs)
     with open(args.idf_out, mode='w') as outf:
-        for word in vocab:
-            outf.write("{}\n".format(log(1 + float(n_sent) / d_freq[word])))
+        outf.writelines("{}\n".format(idf) for idf in idfs.tolist())
 
     logger.info('Filtering embedding...')
-    embed = {}
-    unks = 0
-    with open(args.init_embed) as inf:
-        inf.readline()  # Header
-        for line in inf:
-            word, vector = line.strip().split(' ', 1)
-            wl = word.lower()
-            if word in vocab_set:  # lowercase
-                embed[word] = vector
-            elif wl in vocab_set and wl not in embed:  # uppercase
-                embed[wl] = vector
-            else:
-                unks += 1
-                v = [float(num) for num in vector.split()]
-                if 'UUUNKKK' in embed:
-                    vunk = embed['UUUNKKK']
-                    for i in xrange(len(v)):
-                        vunk[i] += v[i]
-                else:
-                    embed['UUUNKKK'] = v
-        vunk = embed['UUUNKKK']
-        for i in xrange(len(vunk)):
-            vunk[i] = vunk[i] / unks
-        embed['UUUNKKK'] = ' '.join(str(f) for f in vunk)
+    embed = filter_embedding(args.init_embed, vocab_set, logger,
+                             args.processes)
 
     logger.info('Writing embedding...')
     with open(args.embed_out, 'w') as outf:
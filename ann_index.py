@@ -0,0 +1,193 @@
+#coding=utf-8
+"""
+Nearest neighbor search in the cosine sense over embedding matrices.
+
+ExactIndex scores every vector with blocked matrix products. IVFIndex is an
+inverted file index: the vectors are clustered by spherical k-means and each
+query is only compared to the vectors in the nprobe lists whose centroids are
+the closest to it; the candidates are re-ranked exactly. nprobe is the
+recall/speed knob: with nprobe == nlist the results are the same as those of
+ExactIndex.
+
+An IVF index built for foo.mse is saved next to it as
+
+    * foo.mse.ivf.npz: the centroids, the list offsets and the size and
+        mtime of foo.mse (the index is rebuilt if these change), and
+    * foo.mse.ivf-vecs.npy, foo.mse.ivf-ids.npy: the normalized vectors and
+        their row indices in list order, opened with mmap on later runs.
+"""
+
+import logging
+import os
+
+import numpy
+
+from embedding_io import source_stamp
+
+
+def normalize_rows(vecs):
+    """Returns the rows of vecs scaled to unit length (zero rows are kept)."""
+    vecs = numpy.asarray(vecs, dtype='float32')
+    norms = numpy.linalg.norm(vecs, axis=1)
+    norms[norms == 0] = 1
+    return vecs / norms[:, numpy.newaxis]
+
+
+def top_k(queries, normed, k, block_size=32768):
+    """
+    Returns the indices of the k rows of normed that are the most similar to
+    each query in the cosine sense, best first. normed is scored in blocks of
+    block_size rows so that the score matrix stays small; the k best of each
+    block are merged into the running top k with argpartition.
+    """
+    k = min(k, normed.shape[0])
+    rows = numpy.arange(queries.shape[0])[:, numpy.newaxis]
+    best_inds = numpy.empty((queries.shape[0], 0), dtype='int64')
+    best_scores = numpy.empty((queries.shape[0], 0), dtype='float32')
+    for start in xrange(0, normed.shape[0], block_size):
+        scores = queries.dot(normed[start:start + block_size].T)
+        block_k = min(k, scores.shape[1])
+        inds = numpy.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+        best_scores = numpy.hstack([best_scores, scores[rows, inds]])
+        best_inds = numpy.hstack([best_inds, inds + start])
+        if best_inds.shape[1] > k:
+            keep = numpy.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = best_scores[rows, keep]
+            best_inds = best_inds[rows, keep]
+    order = numpy.argsort(-best_scores, axis=1, kind='mergesort')
+    return best_inds[rows, order]
+
+
+def ivf_paths(filen):
+    return ('{}.ivf.npz'.format(filen), '{}.ivf-vecs.npy'.format(filen),
+            '{}.ivf-ids.npy'.format(filen))
+
+
+class ExactIndex():
+    """Brute-force search; the reference for IVFIndex."""
+    def __init__(self, vecs):
+        self.normed = normalize_rows(vecs)
+
+    def search(self, queries, k):
+        return top_k(queries, self.normed, k)
+
+
+class IVFIndex():
+    """Inverted file index with exact re-ranking of the candidates."""
+    def __init__(self, centroids, offsets, vecs, ids, nprobe=16):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.vecs = vecs
+        self.ids = ids
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vecs, nlist, nprobe=16, iterations=10, sample_size=262144,
+              seed=0):
+        """Clusters the rows of vecs into nlist lists with spherical k-means."""
+        normed = normalize_rows(vecs)
+        nlist = min(nlist, normed.shape[0])
+        random = numpy.random.RandomState(seed)
+        sample = normed[random.permutation(normed.shape[0])[:sample_size]]
+        centroids = sample[random.permutation(sample.shape[0])[:nlist]]
+        for it in xrange(iterations):
+            assignment = cls.assign(sample, centroids)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, sample)
+            empty = numpy.bincount(assignment, minlength=nlist) == 0
+            sums[empty] = sample[random.randint(0, sample.shape[0],
+                                                empty.sum())]
+            centroids = normalize_rows(sums)
+            logging.info('k-means iteration {}: {} empty lists'.format(
+                it + 1, empty.sum()))
+        assignment = cls.assign(normed, centroids)
+        ids = numpy.argsort(assignment, kind='mergesort')
+        offsets = numpy.zeros(nlist + 1, dtype='int64')
+        numpy.cumsum(numpy.bincount(assignment, minlength=nlist),
+                     out=offsets[1:])
+        return cls(centroids, offsets, normed[ids], ids, nprobe)
+
+    @staticmethod
+    def assign(normed, centroids, block_size=65536):
+        """The index of the closest centroid for each row of normed."""
+        return numpy.concatenate([
+            normed[start:start + block_size].dot(centroids.T).argmax(axis=1)
+            for start in xrange(0, normed.shape[0], block_size)])
+
+    def save(self, filen):
+        meta_fn, vecs_fn, ids_fn = ivf_paths(filen)
+        try:
+            for fn, array in [(vecs_fn, self.vecs), (ids_fn, self.ids)]:
+                with open(fn + '.tmp', mode='wb') as outfile:
+                    numpy.save(outfile, array)
+                os.rename(fn + '.tmp', fn)
+            # written last: the index is only valid once this exists
+            with open(meta_fn + '.tmp', mode='wb') as outfile:
+                numpy.savez(outfile, centroids=self.centroids,
+                            offsets=self.offsets, stamp=source_stamp(filen))
+            os.rename(meta_fn + '.tmp', meta_fn)
+        except (IOError, OSError) as e:
+            logging.warning('could not save index of {}: {}'.format(filen, e))
+
+    @classmethod
+    def load(cls, filen, nlist, nprobe=16):
+        """Returns the saved index of filen, or None if it is missing/stale."""
+        meta_fn, vecs_fn, ids_fn = ivf_paths(filen)
+        if not all(os.path.isfile(fn) for fn in ivf_paths(filen)):
+            return None
+        meta = numpy.load(meta_fn)
+        ids = numpy.load(ids_fn, mmap_mode='r')
+        # build clamps nlist to the number of vectors
+        if (not numpy.array_equal(meta['stamp'], source_stamp(filen)) or
+                len(meta['offsets']) - 1 != min(nlist, len(ids))):
+            logging.info('{} is stale'.format(meta_fn))
+            return None
+        logging.info('loading index from {}'.format(meta_fn))
+        return cls(meta['centroids'], meta['offsets'],
+                   numpy.load(vecs_fn, mmap_mode='r'), ids, nprobe)
+
+    def search(self, queries, k):
+        """
+        Returns the row indices of the k best candidates for each query, best
+        first; rows with less than k candidates are padded with -1. The
+        queries probing the same list are scored against it in one product.
+        """
+        nlist = self.centroids.shape[0]
+        nprobe = min(self.nprobe, nlist)
+        coarse = queries.dot(self.centroids.T)
+        probes = numpy.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        probe_queries = numpy.repeat(numpy.arange(queries.shape[0]), nprobe)
+        probe_lists = probes.ravel()
+        order = numpy.argsort(probe_lists, kind='mergesort')
+        probe_queries, probe_lists = probe_queries[order], probe_lists[order]
+        bounds = numpy.flatnonzero(numpy.diff(probe_lists)) + 1
+        cand_queries, cand_rows, cand_scores = [], [], []
+        for start, end in zip(numpy.concatenate([[0], bounds]),
+                              numpy.concatenate([bounds, [len(probe_lists)]])):
+            list_id = probe_lists[start]
+            qs = probe_queries[start:end]
+            lstart, lend = self.offsets[list_id], self.offsets[list_id + 1]
+            if lstart == lend:
+                continue
+            scores = self.vecs[lstart:lend].dot(queries[qs].T)
+            list_k = min(k, lend - lstart)
+            best = numpy.argpartition(-scores, list_k - 1, axis=0)[:list_k]
+            cand_queries.append(numpy.repeat(qs[numpy.newaxis, :], list_k,
+                                             axis=0).ravel())
+            cand_rows.append((best + lstart).ravel())
+            cand_scores.append(scores[best, numpy.arange(len(qs))].ravel())
+        result = numpy.empty((queries.shape[0], k), dtype='int64')
+        result.fill(-1)
+        if not cand_queries:
+            return result
+        cand_queries = numpy.concatenate(cand_queries)
+        cand_rows = numpy.concatenate(cand_rows)
+        cand_scores = numpy.concatenate(cand_scores)
+        order = numpy.lexsort((-cand_scores, cand_queries))
+        cand_queries, cand_rows = cand_queries[order], cand_rows[order]
+        starts = numpy.searchsorted(cand_queries,
+                                    numpy.arange(queries.shape[0]))
+        ranks = numpy.arange(len(cand_queries)) - starts[cand_queries]
+        keep = ranks < k
+        result[cand_queries[keep], ranks[keep]] = self.ids[cand_rows[keep]]
+        return result
@@ -0,0 +1,374 @@
+#coding=utf-8
+"""
+Reads embeddings in the w2v/mse text format and caches them in binary form.
+
+The cache of an embedding file foo.mse consists of
+
+    * foo.mse.npy: the vectors as a raw float32 matrix, opened with mmap on
+        later runs so that several processes share one page-cache copy, and
+    * foo.mse.vocab.npz: the vocabulary as a byte blob with an offset array,
+        plus the size and mtime of the source file; the cache is rebuilt if
+        these do not match the source any more.
+
+Large text files are parsed in parallel: the file is split into byte ranges
+aligned to line boundaries, each range is parsed into a float32 block by a
+worker process, and the blocks are yielded in the original order. float32
+rounds the printed numbers: callers that compare the vectors against exact
+thresholds (e.g. sense_count with a cosine threshold of 1) parse them with
+dtype='float64' instead.
+
+Files in the binary word2vec format (see w2v_binary) are read with
+binary=True; they are cached the same way.
+
+If only the vocabulary is needed, scan_vocabs reads the first token of each
+line without parsing the vectors (or only the words of a binary .bin file)
+and saves it as foo.mse.words.npz (in the
+format of the vocabulary sidecar), so that later scans can reuse it. It is
+kept apart from foo.mse.vocab.npz, which is only written together with
+foo.mse.npy and thus vouches for it.
+"""
+
+from collections import deque
+import gzip
+from itertools import islice, izip
+import logging
+from multiprocessing import cpu_count, Pool
+import os
+
+import numpy
+
+from w2v_binary import read_w2v_binary
+
+
+def cache_paths(filen):
+    return '{}.npy'.format(filen), '{}.vocab.npz'.format(filen)
+
+
+def scan_path(filen):
+    return '{}.words.npz'.format(filen)
+
+
+def source_stamp(filen):
+    """The size and mtime of filen, used to detect stale caches."""
+    stat = os.stat(filen)
+    return numpy.array([stat.st_size, stat.st_mtime], dtype='float64')
+
+
+def cached_arrays(filen, cache_fn, build):
+    """
+    Returns the dict of arrays that build(filen) computes. They are saved
+    to cache_fn with the source_stamp of filen, and loaded from there as
+    long as filen has not changed.
+    """
+    stamp = source_stamp(filen)
+    if os.path.isfile(cache_fn):
+        arrays = numpy.load(cache_fn)
+        if numpy.array_equal(arrays['stamp'], stamp):
+            return arrays
+        logging.info('{} is stale'.format(cache_fn))
+    arrays = build(filen)
+    try:
+        with open(cache_fn + '.tmp', mode='wb') as outfile:
+            numpy.savez(outfile, stamp=stamp, **arrays)
+        os.rename(cache_fn + '.tmp', cache_fn)
+    except (IOError, OSError) as e:
+        logging.warning('could not write cache for {}: {}'.format(filen, e))
+    return arrays
+
+
+def open_file(filen, mode='r'):
+    if filen.endswith('.gz'):
+        return gzip.open(filen, mode)
+    else:
+        return open(filen, mode)
+
+
+def parse_lines(lines, words=True, vectors=True, dtype='float32'):
+    """
+    Parses "word f1 f2 ..." lines (or "f1 f2 ..." lines if words is False)
+    into a word list and a float32 (or dtype) matrix; the numbers are
+    converted in one go. If vectors is False, only the words are extracted.
+    """
+    if not words:
+        lines = [line for line in lines if line.strip()]
+        vecs = numpy.fromstring(' '.join(lines), dtype=dtype, sep=' ')
+        return [], vecs.reshape((len(lines), -1) if lines else (0, 0))
+    word_list, rests = [], []
+    for line in lines:
+        fields = line.split(None, 1)
+        if fields:
+            word_list.append(fields[0])
+            rests.append(fields[1] if len(fields) == 2 else '')
+    if not vectors:
+        return word_list, None
+    vecs = numpy.fromstring(' '.join(rests), dtype=dtype, sep=' ')
+    if not word_list:
+        return word_list, vecs.reshape((0, 0))
+    if vecs.size % len(word_list):
+        raise ValueError('ragged vectors in block starting with {}'.format(
+            word_list[0]))
+    return word_list, vecs.reshape((len(word_list), -1))
+
+
+def line_aligned_ranges(filen, chunk_bytes, header=True):
+    """
+    Splits filen into (start, end) byte ranges of about chunk_bytes that
+    start and end at line boundaries, skipping the header line if any.
+    """
+    size = os.path.getsize(filen)
+    with open(filen, 'rb') as infile:
+        if header:
+            infile.readline()
+        bounds = [infile.tell()]
+        while bounds[-1] < size:
+            infile.seek(max(bounds[-1] + chunk_bytes, bounds[-1] + 1) - 1)
+            infile.readline()
+            bounds.append(min(infile.tell(), size))
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _parse_range(task):
+    filen, start, end, words, vectors, dtype = task
+    with open(filen, 'rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    return parse_lines(data.split('\n'), words, vectors, dtype)
+
+
+def iter_text_blocks(filen, header=True, words=True, vectors=True,
+                     block_lines=10000, dtype='float32'):
+    """Yields parsed blocks of block_lines lines, read sequentially."""
+    with open_file(filen) as infile:
+        if header:
+            infile.readline()
+        lines = []
+        for line in infile:
+            lines.append(line)
+            if len(lines) == block_lines:
+                yield parse_lines(lines, words, vectors, dtype)
+                lines = []
+        if lines:
+            yield parse_lines(lines, words, vectors, dtype)
+
+
+def imap_bounded(pool, func, tasks, window):
+    """
+    Like pool.imap, but at most window tasks are submitted ahead of the
+    consumer, so that the results of a slow consumer do not pile up.
+    """
+    tasks = iter(tasks)
+    pending = deque(pool.apply_async(func, (task,))
+                    for task in islice(tasks, window))
+    while pending:
+        result = pending.popleft().get()
+        for task in islice(tasks, 1):
+            pending.append(pool.apply_async(func, (task,)))
+        yield result
+
+
+def iter_parsed_chunks(filen, header=True, words=True, vectors=True,
+                       processes=None, chunk_bytes=1 << 26, dtype='float32'):
+    """
+    Yields the (words, vectors) blocks of a w2v/mse text file in order. The
+    blocks are parsed by a pool of processes (all cores by default); gzipped
+    files cannot be split, so they are read sequentially.
+    """
+    if filen.endswith('.gz'):
+        for block in iter_text_blocks(filen, header, words, vectors,
+                                      dtype=dtype):
+            yield block
+        return
+    processes = processes or cpu_count()
+    tasks = [(filen, start, end, words, vectors, dtype) for start, end in
+             line_aligned_ranges(filen, chunk_bytes, header)]
+    if processes == 1 or len(tasks) < 2:
+        for task in tasks:
+            yield _parse_range(task)
+        return
+    processes = min(processes, len(tasks))
+    pool = Pool(processes)
+    try:
+        for block in imap_bounded(pool, _parse_range, tasks, 2 * processes):
+            yield block
+    finally:
+        pool.terminate()
+
+
+def read_vectors(filen, header=True, words=True, processes=None,
+                 binary=False, dtype='float32'):
+    """
+    Returns the words and the float32 (or dtype) matrix of a w2v/mse text
+    file, or the float32 matrix of a file in the word2vec binary format if
+    binary is True.
+    """
+    if binary:
+        return read_w2v_binary(filen)
+    vocab, blocks = [], []
+    for block_words, vecs in iter_parsed_chunks(
+            filen, header, words, processes=processes, dtype=dtype):
+        vocab.extend(block_words)
+        blocks.append(vecs)
+    blocks = [vecs for vecs in blocks if vecs.size]
+    vecs = numpy.vstack(blocks) if blocks else numpy.zeros((0, 0), dtype)
+    return vocab, vecs
+
+
+def read_vocab_sidecar(filen, header=True, vocab_fn=None):
+    """
+    Returns the cached vocabulary of filen, or None if it is stale. vocab_fn
+    is the sidecar of the cache by default.
+    """
+    if vocab_fn is None:
+        _, vocab_fn = cache_paths(filen)
+    if not os.path.isfile(vocab_fn):
+        return None
+    sidecar = numpy.load(vocab_fn)
+    if (not numpy.array_equal(sidecar['stamp'], source_stamp(filen)) or
+            bool(sidecar['header']) != header):
+        logging.info('{} is stale'.format(vocab_fn))
+        return None
+    blob = sidecar['blob'].tostring()
+    offsets = sidecar['offsets']
+    return [blob[offsets[i]:offsets[i + 1]]
+            for i in xrange(len(offsets) - 1)]
+
+
+def write_vocab_sidecar(filen, vocab, header=True, vocab_fn=None):
+    if vocab_fn is None:
+        _, vocab_fn = cache_paths(filen)
+    offsets = numpy.zeros(len(vocab) + 1, dtype='int64')
+    numpy.cumsum([len(word) for word in vocab], out=offsets[1:])
+    blob = numpy.frombuffer(''.join(vocab), dtype='uint8')
+    with open(vocab_fn + '.tmp', mode='wb') as outfile:
+        numpy.savez(outfile, blob=blob, offsets=offsets,
+                    stamp=source_stamp(filen), header=header)
+    os.rename(vocab_fn + '.tmp', vocab_fn)
+
+
+def first_tokens(data):
+    """The first token of each non-blank line of data."""
+    tokens = []
+    pos, size = 0, len(data)
+    while pos < size:
+        end = data.find('\n', pos)
+        if end < 0:
+            end = size
+        space = data.find(' ', pos, end)
+        fields = data[pos:space if space >= 0 else end].split()
+        if not fields:
+            # the line starts with whitespace or is blank
+            fields = data[pos:end].split(None, 1)
+        if fields:
+            tokens.append(fields[0])
+        pos = end + 1
+    return tokens
+
+
+def _scan_range(task):
+    filen, start, end = task
+    tokens = []
+    with open(filen, 'rb') as infile:
+        infile.seek(start)
+        while start < end:
+            data = infile.read(min(1 << 24, end - start))
+            start += len(data)
+            if start < end:
+                line_end = infile.readline()
+                start += len(line_end)
+                data += line_end
+            tokens.extend(first_tokens(data))
+    return tokens
+
+
+def scan_vocabs(filens, header=True, processes=None, chunk_bytes=1 << 26):
+    """
+    Returns the vocabulary of each w2v/mse file in filens, reading only the
+    first token of each line (files ending with .bin are read as binary). The byte ranges of all files are scanned
+    by one pool of processes (all cores by default). The vocabularies are
+    taken from the vocabulary sidecars of the caches or from earlier scans;
+    the scanned ones are saved for the latter.
+    """
+    vocabs = [read_vocab_sidecar(filen, header) for filen in filens]
+    vocabs = [read_vocab_sidecar(filen, header, scan_path(filen))
+              if vocab is None else vocab
+              for filen, vocab in zip(filens, vocabs)]
+    scanned = [i for i, vocab in enumerate(vocabs) if vocab is None]
+    tasks, owners = [], []
+    for i in scanned:
+        filen = filens[i]
+        vocabs[i] = []
+        if filen.endswith('.bin'):
+            vocabs[i], _ = read_w2v_binary(filen, vectors=False)
+            continue
+        if filen.endswith('.gz'):
+            for block_words, _ in iter_text_blocks(filen, header,
+                                                   vectors=False):
+                vocabs[i].extend(block_words)
+            continue
+        logging.info('scanning the vocabulary of {} ...'.format(filen))
+        for start, end in line_aligned_ranges(filen, chunk_bytes, header):
+            tasks.append((filen, start, end))
+            owners.append(i)
+    processes = min(processes or cpu_count(), len(tasks))
+    if processes > 1:
+        pool = Pool(processes)
+        results = pool.imap(_scan_range, tasks)
+    else:
+        results = (_scan_range(task) for task in tasks)
+    for i, tokens in izip(owners, results):
+        vocabs[i].extend(tokens)
+    if processes > 1:
+        pool.close()
+        pool.join()
+    for i in scanned:
+        try:
+            write_vocab_sidecar(filens[i], vocabs[i], header,
+                                scan_path(filens[i]))
+        except (IOError, OSError) as e:
+            logging.warning('could not write the vocabulary of {}: {}'.format(
+                filens[i], e))
+    return vocabs
+
+
+def scan_vocab(filen, header=True, processes=None):
+    """Returns the vocabulary of a w2v/mse file (see scan_vocabs)."""
+    return scan_vocabs([filen], header, processes)[0]
+
+
+def build_cache(filen, header=True, binary=False):
+    """Parses filen and writes its cache; returns (vocab, vecs)."""
+    logging.info('building binary cache for {} ...'.format(filen))
+    vocab, vecs = read_vectors(filen, header, binary=binary)
+    if header and not binary:
+        with open(filen) as infile:
+            vocab_size = int(infile.readline().split()[0])
+        if len(vocab) != vocab_size:
+            logging.warn('vocab size is {}, header says {}'.format(
+                len(vocab), vocab_size))
+    npy_fn, _ = cache_paths(filen)
+    try:
+        with open(npy_fn + '.tmp', mode='wb') as outfile:
+            numpy.save(outfile, vecs)
+        os.rename(npy_fn + '.tmp', npy_fn)
+        write_vocab_sidecar(filen, vocab, header)
+    except (IOError, OSError) as e:
+        logging.warning('could not write cache for {}: {}'.format(filen, e))
+    return vocab, vecs
+
+
+def load_embedding(filen, header=True, binary=False):
+    """
+    Returns the vocabulary and the (memory-mapped, float32) vectors of a
+    w2v/mse text file (or a binary one if binary is True), building the cache
+    on the first call.
+    """
+    npy_fn, _ = cache_paths(filen)
+    vocab = read_vocab_sidecar(filen, header)
+    if vocab is None or not os.path.isfile(npy_fn):
+        return build_cache(filen, header, binary)
+    vecs = numpy.load(npy_fn, mmap_mode='r')
+    if len(vocab) != vecs.shape[0]:
+        logging.info('{} does not match its vocabulary'.format(npy_fn))
+        return build_cache(filen, header, binary)
+    logging.info('loading cached embedding from {}'.format(npy_fn))
+    return vocab, vecs
@@ -0,0 +1,106 @@
+#coding=utf-8
+"""
+External merge sort for record streams that do not fit into memory.
+
+Records (tuples of strings and numbers) are collected in memory until their
+estimated size reaches the memory budget; the buffer is then sorted and
+pickled into a temporary run file. Iterating over the sorter merges the runs
+lazily with heapq.merge, so the sorted records are consumed in one streaming
+pass. If nothing was spilled, the buffer is simply sorted in memory.
+
+Every run keeps a file descriptor open, so at most MAX_FAN_IN runs are
+merged at once: whenever MAX_FAN_IN runs of the same level have been
+written, they are merged into one run of the next level, and the final
+merge first reduces the remaining runs to MAX_FAN_IN. The number of open
+runs thus grows only with the logarithm of the number of spills.
+"""
+
+import cPickle
+import heapq
+import logging
+import tempfile
+
+# Rough per-record overhead of a tuple of small Python objects in a list
+RECORD_OVERHEAD = 120
+# The largest number of runs merged (and open) at once
+MAX_FAN_IN = 64
+
+
+def record_size(record):
+    """A rough estimate of the memory used by a record, in bytes."""
+    return RECORD_OVERHEAD + sum(len(field) if isinstance(field, str) else 24
+                                 for field in record)
+
+
+def read_run(run_file):
+    run_file.seek(0)
+    unpickler = cPickle.Unpickler(run_file)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+
+class ExternalSorter():
+    def __init__(self, memory=1 << 30, tmp_dir=None):
+        self.memory = memory
+        self.tmp_dir = tmp_dir
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.buffer_size += record_size(record)
+        if self.buffer_size >= self.memory:
+            self.spill()
+
+    def write_run(self, records):
+        """Writes the sorted records into a new run file."""
+        run_file = tempfile.TemporaryFile(dir=self.tmp_dir)
+        pickler = cPickle.Pickler(run_file, cPickle.HIGHEST_PROTOCOL)
+        for record in records:
+            pickler.dump(record)
+            # the memo would keep every record alive
+            pickler.clear_memo()
+        return run_file
+
+    def spill(self):
+        """Writes the buffer into a sorted run file."""
+        self.buffer.sort()
+        self.runs.append((0, self.write_run(self.buffer)))
+        logging.debug('spilled run {} ({} records)'.format(
+            len(self.runs), len(self.buffer)))
+        self.buffer, self.buffer_size = [], 0
+        # the levels of the runs never increase along the list
+        while (len(self.runs) >= MAX_FAN_IN and
+               self.runs[-MAX_FAN_IN][0] == self.runs[-1][0]):
+            self.merge_runs(MAX_FAN_IN)
+
+    def merge_runs(self, count):
+        """Replaces the last count runs with one run that merges them."""
+        runs = self.runs[-count:]
+        merged = self.write_run(heapq.merge(
+            *[read_run(run_file) for _, run_file in runs]))
+        for _, run_file in runs:
+            run_file.close()
+        self.runs[-count:] = [(runs[0][0] + 1, merged)]
+        logging.debug('merged {} runs into one of level {}'.format(
+            count, runs[0][0] + 1))
+
+    def __iter__(self):
+        """Yields the records in sorted order."""
+        if not self.runs:
+            self.buffer.sort()
+            return iter(self.buffer)
+        if self.buffer:
+            self.spill()
+        while len(self.runs) > MAX_FAN_IN:
+            self.merge_runs(min(MAX_FAN_IN, len(self.runs) - MAX_FAN_IN + 1))
+        return heapq.merge(*[read_run(run_file) for _, run_file in self.runs])
+
+    def close(self):
+        for _, run_file in self.runs:
+            run_file.close()
+        self.buffer, self.runs = [], []
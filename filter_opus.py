@@ -1,13 +1,80 @@
+"""
+Removes the malformed lines (written to stderr) and the duplicate pairs from
+a "source translation" dictionary read from stdin; the distinct pairs are
+printed in the order of their first occurrence.
+
+The pairs seen so far are kept in a set. If they outgrow the memory budget,
+the (pair, position) records are sorted externally to find the first
+occurrence of each pair, and these are sorted back into input order.
+"""
+
+import argparse
+from itertools import groupby
 import sys
 
-V = []
+from external_sort import ExternalSorter, record_size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Removes the malformed lines and the duplicate pairs '
+                    'from a dictionary read from stdin.')
+    parser.add_argument('--memory', '-m', type=int, default=1024,
+                        help='the memory budget of the deduplication in MB; '
+                             'above it, the pairs are sorted on disk')
+    parser.add_argument('--tmp-dir', help='the directory of the sorted runs '
+                                          '(the system default if not set)')
+    return parser.parse_args()
+
+
+def read_pairs(infile):
+    """Yields the position and the pair of each well-formed line."""
+    for i, line in enumerate(infile):
+        parts = line.strip().split()
+        if len(parts) != 2:
+            sys.stderr.write(line)
+        else:
+            yield i, ' '.join(parts)
+
+
+def dedup(pairs, memory, tmp_dir=None):
+    """
+    Yields the distinct pairs of the (position, pair) stream in the order of
+    their first occurrence.
+    """
+    seen, firsts = set(), []
+    size = 0
+    for i, pair in pairs:
+        if pair not in seen:
+            seen.add(pair)
+            firsts.append((i, pair))
+            size += record_size((i, pair)) + len(pair)
+            if size > memory:
+                break
+    else:
+        for _, pair in firsts:
+            yield pair
+        return
+
+    del seen
+    by_pair = ExternalSorter(memory, tmp_dir)
+    # popped one by one, so that firsts shrinks while the sorter fills up
+    firsts.reverse()
+    while firsts:
+        i, pair = firsts.pop()
+        by_pair.add((pair, i))
+    for i, pair in pairs:
+        by_pair.add((pair, i))
+    by_position = ExternalSorter(memory, tmp_dir)
+    for pair, records in groupby(by_pair, key=lambda record: record[0]):
+        by_position.add((next(records)[1], pair))
+    by_pair.close()
+    for _, pair in by_position:
+        yield pair
+    by_position.close()
 
-for line in sys.stdin:
-    parts = line.strip().split()
-    if len(parts) != 2:
-        sys.stderr.write(line)
-    elif parts not in V:
-        V.append(parts)
 
-for source, translation in V:
-    print source, translation
+if __name__ == '__main__':
+    args = parse_args()
+    for pair in dedup(read_pairs(sys.stdin), args.memory << 20, args.tmp_dir):
+        sys.stdout.write(pair + '\n')
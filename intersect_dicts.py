@@ -1,12 +1,6 @@
 import sys
 
-def read_from_mse(file):
-    V=set()
-    file.readline()
-    for line in file:
-        word = line.strip().split()[0]
-        V.add(word)
-    return V
+from embedding_io import scan_vocabs
 
 if "-" not in sys.argv:
     print >>sys.stderr, "No - was given!"
@@ -19,18 +13,22 @@ if len(lang1_files) == 0 or len(lang2_files) == 0:
     print >>sys.stderr, "There are no files for one or both of the languages!"
     exit(1)
 
-V1 = read_from_mse(open(lang1_files[0]))
-V2 = read_from_mse(open(lang2_files[0]))
+vocabs = map(set, scan_vocabs(lang1_files + lang2_files))
+lang1_vocabs = vocabs[:len(lang1_files)]
+lang2_vocabs = vocabs[len(lang1_files):]
+
+V1 = lang1_vocabs[0]
+V2 = lang2_vocabs[0]
 
 print >>sys.stderr, len(V1)
 
-for file in lang1_files[1:]:
-    V1 &= read_from_mse(open(file))
+for vocab in lang1_vocabs[1:]:
+    V1 &= vocab
     print >>sys.stderr, len(V1)
 
 print >>sys.stderr, "",  len(V2)
-for file in lang2_files[1:]:
-    V2 &= read_from_mse(open(file))
+for vocab in lang2_vocabs[1:]:
+    V2 &= vocab
     print >>sys.stderr, "",  len(V2)
 
 i = 0
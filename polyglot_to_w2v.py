@@ -1,11 +1,31 @@
+import argparse
 import codecs
 import pickle
-import sys
-
-pmodel = pickle.load(open(sys.argv[1]))
-items = zip(*pmodel)
-with codecs.open(sys.argv[2], mode='w', encoding='utf-8') as w2v_file:
-    w2v_file.write('{} {}\n'.format(len(items), len(items[0][1])))
-    for word, vec in items:
-        w2v_file.write(word)
-        w2v_file.write(' {}\n'.format(' '.join(map(str, vec))))
+
+import numpy
+
+from w2v_binary import write_w2v_binary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Converts a pickled polyglot model to the w2v format.')
+    parser.add_argument('pickle')
+    parser.add_argument('w2v')
+    parser.add_argument('--binary', '-b', action='store_true',
+                        help='write the binary word2vec format')
+    return parser.parse_args()
+
+
+args = parse_args()
+pmodel = pickle.load(open(args.pickle))
+if args.binary:
+    words, vecs = pmodel
+    write_w2v_binary(args.w2v, list(words), numpy.asarray(vecs))
+else:
+    items = zip(*pmodel)
+    with codecs.open(args.w2v, mode='w', encoding='utf-8') as w2v_file:
+        w2v_file.write('{} {}\n'.format(len(items), len(items[0][1])))
+        for word, vec in items:
+            w2v_file.write(word)
+            w2v_file.write(' {}\n'.format(' '.join(map(str, vec))))
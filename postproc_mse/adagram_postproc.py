@@ -1,9 +1,17 @@
 import argparse
 import logging
 import os
+import shutil
+import sys
+import tempfile
 
 import numpy
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from embedding_io import iter_parsed_chunks
+from w2v_binary import W2VBinaryWriter
+
 class AdagramToWord2vecConverter():
     """
     Converts  an AdaGram VSM to a word2vec-like format
@@ -35,6 +43,9 @@ class AdagramToWord2vecConverter():
             "-s", "--max-sense-num", type=int, default=5, metavar="K",
             dest="max_sense_num", 
             help="only keep the K most frequent (highest PI) senses")
+        arg_parser.add_argument(
+            "-b", "--binary", action="store_true",
+            help="write the binary word2vec format")
         self.argv = arg_parser.parse_args()
         
     def __init__(self):
@@ -42,44 +53,66 @@ class AdagramToWord2vecConverter():
         logging.basicConfig(level=logging.DEBUG, format=format_)
         self.parse_args()
         self.vocab = [line.strip() for line in open(self.argv.vocab)]
-        self.get_embed()
-        self.outfile = open(self.argv.outfile, mode="w")
 
-    def get_embed(self):
-        filename, ext = os.path.splitext(self.argv.vectors)
-        logging.info("Reading embedding from {} ...".format(self.argv.vectors))
-        flat_vm = self.iter_loadtxt(self.argv.vectors, dtype=float)
-        new_shape = (-1, self.argv.dimension, flat_vm.shape[1])
-        self.vm = flat_vm.reshape(new_shape)
+    def iter_blocks(self, dtype='float32'):
+        """
+        Yields the words and the nonzero sense vectors (among the first K) of
+        the words in each parsed block of the Julia dump, in which a word is
+        dimension consecutive rows with a column per sense. Rows that
+        continue in the next block are carried over.
+        """
+        dim, k = self.argv.dimension, self.argv.max_sense_num
+        first, carry = 0, None
+        for _, rows in iter_parsed_chunks(self.argv.vectors, header=False,
+                                          words=False, dtype=dtype):
+            if carry is not None and carry.size:
+                rows = numpy.vstack([carry, rows]) if rows.size else carry
+            n_words = min(len(rows) // dim, len(self.vocab) - first)
+            carry = rows[n_words * dim:]
+            if n_words <= 0:
+                continue
+            # (words, dim, senses) -> (words, senses, dim)
+            senses = rows[:n_words * dim].reshape(
+                n_words, dim, -1).transpose(0, 2, 1)[:, :k]
+            nonzero = numpy.any(senses, axis=2)
+            words = numpy.repeat(self.vocab[first:first + n_words],
+                                 nonzero.sum(axis=1))
+            first += n_words
+            yield words, senses[nonzero]
 
-    def iter_loadtxt(self, filename, delimiter=None, skiprows=0, dtype=float):
-        def iter_func():
-            with open(filename, 'r') as infile:
-                for _ in range(skiprows):
-                    next(infile)
-                for line in infile:
-                    line = line.rstrip().split(delimiter)
-                    for item in line:
-                        yield dtype(item)
-            self.rowlength = len(line)
-            
-        data = numpy.fromiter(iter_func(), dtype=dtype)
-        data = data.reshape((-1, self.rowlength))
-        return data
+    def write_text(self, outfile):
+        """
+        Writes the text embedding in one pass: the header needs the number
+        of rows, so the rows go to a temporary file first, which is then
+        copied after the header. The numbers are formatted from float64.
+        """
+        body = tempfile.TemporaryFile(dir=os.path.dirname(
+            os.path.abspath(self.argv.outfile)))
+        big_voc_size = 0
+        for words, vecs in self.iter_blocks(dtype='float64'):
+            body.writelines("{} {}\n".format(word, " ".join(
+                str(cell) for cell in vec)) for word, vec in zip(words, vecs))
+            big_voc_size += len(words)
+        outfile.write("{} {}\n".format(big_voc_size, self.argv.dimension))
+        body.seek(0)
+        shutil.copyfileobj(body, outfile, 1 << 24)
+        body.close()
+        return big_voc_size
 
     def main(self):
-        big_voc_size = int(sum(numpy.minimum(
-            numpy.sum(numpy.any(self.vm, axis=1), axis=1),
-            self.argv.max_sense_num*numpy.ones((1,self.vm.shape[0]))).reshape(-1)))
-        logging.info("Writing embedding with shape {} {} to {} ...".format(
-            big_voc_size, self.vm.shape[1], self.argv.outfile))
-        self.outfile.write("{} {}\n".format(big_voc_size, self.vm.shape[1]))
-        for word, vecs in zip(self.vocab, self.vm):
-            for vec in vecs.T[:self.argv.max_sense_num]:
-                if numpy.any(vec):
-                    self.outfile.write("{} {}\n".format(word, " ".join(
-                        str(cell) for cell in vec)))
-
+        logging.info("Converting {} ...".format(self.argv.vectors))
+        with open(self.argv.outfile,
+                  mode="wb" if self.argv.binary else "w") as outfile:
+            if self.argv.binary:
+                # the row count is filled in by finish
+                writer = W2VBinaryWriter(outfile, None, self.argv.dimension)
+                for words, vecs in self.iter_blocks():
+                    writer.write_rows(words, vecs)
+                big_voc_size = writer.finish()
+            else:
+                big_voc_size = self.write_text(outfile)
+        logging.info("Wrote embedding with shape {} {} to {}".format(
+            big_voc_size, self.argv.dimension, self.argv.outfile))
 
 if __name__ == "__main__":
     AdagramToWord2vecConverter().main() 
@@ -1,4 +1,12 @@
 import argparse
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, os.pardir))
+from w2v_binary import write_w2v_binary
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -6,6 +14,8 @@ def parse_args():
     parser.add_argument('vocab')
     parser.add_argument('sense_vects')
     parser.add_argument('--out_fn')
+    parser.add_argument('--binary', action='store_true',
+                        help='write the binary word2vec format')
     return parser.parse_args()
 
 
@@ -38,6 +48,13 @@ def jiweil_postproc(args):
                 output_lines.append('{} {} {}'.format(full_vocab[word_i], field1, tail))
     if not args.out_fn:
         args.out_fn = '{}.mse'.format(args.sense_vects) 
+    if args.binary:
+        words, vectors = zip(*(line.split(maxsplit=1)
+                               for line in output_lines))
+        vecs = numpy.array([numpy.fromstring(vector, dtype='float32', sep=' ')
+                            for vector in vectors])
+        write_w2v_binary(args.out_fn, words, vecs, len(used_vocab))
+        return
     with open(args.out_fn, mode='w') as out_f:
         out_f.write('{} {}\n'.format(len(used_vocab), args.dim))
         for line in output_lines:
@@ -1,14 +1,22 @@
 import argparse
 import gzip
+import os
 from os.path import splitext
 import sys
 import logging
 
-def neela_filter(inembed_fn, global_fn, sense_fn, ccent_fn):
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from w2v_binary import W2VBinaryWriter
+
+def neela_filter(inembed_fn, global_fn, sense_fn, ccent_fn, binary=False):
+    mode = 'wb' if binary else 'w'
     with gzip.open(inembed_fn) as inembed_f, \
-            open(global_fn, mode='w') as global_f, \
-            open(sense_fn, mode='w') as sense_f, \
-            open(ccent_fn, mode='w') as ccent_f:
+            open(global_fn, mode=mode) as global_f, \
+            open(sense_fn, mode=mode) as sense_f, \
+            open(ccent_fn, mode=mode) as ccent_f:
         header = inembed_f.readline().strip().split()
         if len(header) == 4:
             vocab_size, dim, max_sense, minus = (int(str_) for str_ in header)
@@ -17,8 +25,17 @@ def neela_filter(inembed_fn, global_fn, sense_fn, ccent_fn):
             vocab_size, dim = header
             vec_per_sense = 2
         sense_files = [sense_f, ccent_f][:int(vec_per_sense)]
-        for file_ in global_f, sense_f, ccent_f:
-            file_.write('{} {}\n'.format(vocab_size, dim))
+        if binary:
+            writers = {file_: W2VBinaryWriter(file_, vocab_size, int(dim))
+                       for file_ in (global_f, sense_f, ccent_f)}
+            def write(file_, word, vector):
+                writers[file_].write(word, numpy.fromstring(
+                    vector, dtype='float32', sep=' '))
+        else:
+            for file_ in global_f, sense_f, ccent_f:
+                file_.write('{} {}\n'.format(vocab_size, dim))
+            def write(file_, word, vector):
+                file_.write('{} {}'.format(word, vector))
         count = 0
         while True:
             line = inembed_f.readline()
@@ -40,13 +57,13 @@ def neela_filter(inembed_fn, global_fn, sense_fn, ccent_fn):
                 vector = inembed_f.readline() # vector ends with '\n'
                 if word:
                     logging.debug('global')
-                    global_f.write('{} {}'.format(word, vector))
+                    write(global_f, word, vector)
                 for sense in range(int(sense_num)):
                     logging.debug('sense {}'.format(sense_num))
                     for file_ in sense_files:
                         vector = inembed_f.readline() # vector end with '\n'
                         if word:
-                            file_.write('{} {}'.format(word, vector))
+                            write(file_, word, vector)
             else:
                 sys.stdout.write('\n'.format(float(count)/vocab_size))
                 break
@@ -59,6 +76,8 @@ def parse_args():
     parser.add_argument('--glob')
     parser.add_argument('--sense')
     parser.add_argument('--clust_cent')
+    parser.add_argument('--binary', action='store_true',
+                        help='write the binary word2vec format')
     args = parser.parse_args()
     if not args.glob or not args.sense or not args.clust_cent:
         if not args.glob and not args.sense and not args.clust_cent:
@@ -75,4 +94,5 @@ if __name__ == '__main__':
     format_ = "%(asctime)s %(module)s (%(lineno)s) %(levelname)s %(message)s"
     logging.basicConfig(level=logging.INFO, format=format_)
     args = parse_args()
-    neela_filter(args.inembed_gz, args.glob, args.sense, args.clust_cent)
+    neela_filter(args.inembed_gz, args.glob, args.sense, args.clust_cent,
+                 args.binary)
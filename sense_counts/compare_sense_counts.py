@@ -3,13 +3,14 @@
 
 """Compares sense counts."""
 from argparse import ArgumentParser
-from operator import itemgetter
 import re
 
 import numpy as np
 from scipy.stats import entropy, linregress, pearsonr, spearmanr
 from sklearn.metrics import cohen_kappa_score
 
+from count_files import read_count_arrays
+
 
 def parse_arguments():
     parser = ArgumentParser(
@@ -24,17 +25,16 @@ def parse_arguments():
                              'order for this to word, the subtracted '
                              'dictionary has to include all words that occur '
                              'in file1 and file2.')
+    parser.add_argument('--bootstrap', '-b', type=int, default=0,
+                        help='the number of bootstrap resamples used to '
+                             'compute confidence intervals for Spearman and '
+                             'Pearson; no intervals if 0 (the default).')
+    parser.add_argument('--confidence', '-c', type=float, default=0.95,
+                        help='the confidence level of the intervals.')
     args = parser.parse_args()
 
-    return args.file1, args.file2, args.lower, args.partial
-
-
-def read_dict_file(dict_file, lower):
-    def _lower(s):
-        return s.lower() if lower else s
-    with open(dict_file) as inf:
-        return {_lower(k): float(v) for k, v in
-                (line.strip().split("\t") for line in inf)}
+    return (args.file1, args.file2, args.lower, args.partial, args.bootstrap,
+            args.confidence)
 
 
 def js_divergence(p, q):
@@ -46,54 +46,133 @@ def cos_number(a, b):
     return (a / np.linalg.norm(a)).dot(b / np.linalg.norm(b))
 
 
-def common_dicts(dict1, dict2):
+class CountTable():
     """
-    Return the parts of dict1 and dict2 that correspond to the common keys in
-    both as lists of tuples.
+    Count files loaded into a shared, sorted vocabulary index: for each file,
+    a column of counts over the whole vocabulary and a mask of the words that
+    occur in the file. Intersections are mask operations, and the columns are
+    in the same (sorted) word order, so they can be compared directly.
     """
-    common_keys = dict1.viewkeys() & dict2.viewkeys()
-    d1 = {k: v for k, v in dict1.iteritems() if k in common_keys}
-    d2 = {k: v for k, v in dict2.iteritems() if k in common_keys}
-    l1 = sorted(d1.iteritems(), key=itemgetter(0))
-    l2 = sorted(d2.iteritems(), key=itemgetter(0))
-    return l1, l2, common_keys
-
-
-def dict_vectors(dict1, dict2):
-    """Returns the dictionary vectors for the common keys."""
-    l1, l2, common_keys = common_dicts(dict1, dict2)
-    v1 = np.array(map(itemgetter(1), l1))
-    v2 = np.array(map(itemgetter(1), l2))
-    return v1, v2, common_keys
+    def __init__(self, files, lower=False):
+        arrays = {f: read_count_arrays(f, lower) for f in set(files)}
+        self.keys = np.unique(np.concatenate(
+            [np.array([], dtype=str)] + [k for k, _ in arrays.itervalues()]))
+        self.columns = {}
+        for f, (keys, counts) in arrays.iteritems():
+            positions = np.searchsorted(self.keys, keys)
+            values = np.zeros(len(self.keys))
+            values[positions] = counts
+            mask = np.zeros(len(self.keys), dtype=bool)
+            mask[positions] = True
+            self.columns[f] = values, mask
+
+    def column(self, f):
+        """The (counts, mask) pair of file f."""
+        return self.columns[f]
+
+
+def compare_columns(column1, column2, bootstrap=0, confidence=0.95):
+    """
+    Computes various correlation metrics between two (counts, mask) columns
+    on the words they share.
+    """
+    (v1, m1), (v2, m2) = column1, column2
+    common = m1 & m2
+    metrics = compare_vectors(v1[common], v2[common], bootstrap, confidence)
+    metrics.update(dict1=m1.sum(), dict2=m2.sum())
+    return metrics
 
 
-def compare_dicts(dict1, dict2):
-    """Computes various correlation metrics between two dictionaries."""
-    v1, v2, common_keys = dict_vectors(dict1, dict2)
+def compare_vectors(v1, v2, bootstrap=0, confidence=0.95):
+    """
+    Computes the metrics of compare_columns for two aligned vectors. If
+    bootstrap is positive, percentile confidence intervals are computed for
+    Spearman and Pearson from that many resamples.
+    """
     sp = tuple(spearmanr(v1, v2))
     ps = pearsonr(v1, v2)
     cn = cos_number(v1, v2)
     kappa = cohen_kappa_score(v1.round(), v2.round())
     dist1 = v1 / v1.sum()
     dist2 = v2 / v2.sum()
-    return {'dict1': len(dict1), 'dict2': len(dict2), 'common': len(common_keys),
-            'kl': entropy(dist1, dist2), 'js': js_divergence(dist1, dist2),
-            'spearman': sp, 'pearson': ps, 'cos': cn, 'kappa': kappa}
+    metrics = {'common': len(v1),
+               'kl': entropy(dist1, dist2), 'js': js_divergence(dist1, dist2),
+               'spearman': sp, 'pearson': ps, 'cos': cn, 'kappa': kappa}
+    if bootstrap > 0:
+        spearmans, pearsons = bootstrap_correlations(v1, v2, bootstrap)
+        percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+        metrics['spearman_ci'] = tuple(np.nanpercentile(spearmans, percentiles))
+        metrics['pearson_ci'] = tuple(np.nanpercentile(pearsons, percentiles))
+    return metrics
+
+
+def average_ranks(codes, num_codes, samples):
+    """
+    The ranks (ties get the average rank, as in spearmanr) of the values in
+    each row of samples, which holds indices into codes, the dense ranks of
+    the values (0 .. num_codes - 1).
+    """
+    sample_codes = codes[samples]
+    offsets = np.arange(len(samples))[:, np.newaxis] * num_codes
+    counts = np.bincount((sample_codes + offsets).ravel(),
+                         minlength=len(samples) * num_codes).reshape(
+                             len(samples), num_codes)
+    ranks = np.cumsum(counts, axis=1) - counts + (counts + 1) / 2.0
+    return ranks[np.arange(len(samples))[:, np.newaxis], sample_codes]
+
+
+def rowwise_pearson(x, y):
+    """The Pearson correlation of each row of x with the same row of y."""
+    x = x - x.mean(axis=1)[:, np.newaxis]
+    y = y - y.mean(axis=1)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (x * y).sum(axis=1) / np.sqrt((x * x).sum(axis=1) *
+                                             (y * y).sum(axis=1))
 
 
-def subtract_dict(data_dict, base_dict):
+def bootstrap_correlations(v1, v2, replicates, seed=0, max_cells=1 << 24):
     """
-    Subtracts the effect of base_dict from data_dict via partial correlation.
+    Returns the Spearman and Pearson correlations of replicates bootstrap
+    resamples of the aligned vectors v1 and v2. The resample indices of a
+    block of replicates are drawn as one matrix, and the ranks and
+    correlations of the whole block are computed together; blocks are
+    limited to max_cells indices to bound memory.
+    """
+    random = np.random.RandomState(seed)
+    codes1, codes2 = [np.unique(v, return_inverse=True)[1] for v in (v1, v2)]
+    num1, num2 = codes1.max() + 1, codes2.max() + 1
+    block_size = max(1, max_cells // len(v1))
+    spearmans, pearsons = [], []
+    for start in xrange(0, replicates, block_size):
+        samples = random.randint(
+            0, len(v1), (min(block_size, replicates - start), len(v1)))
+        pearsons.append(rowwise_pearson(v1[samples], v2[samples]))
+        spearmans.append(rowwise_pearson(
+            average_ranks(codes1, num1, samples),
+            average_ranks(codes2, num2, samples)))
+    return np.concatenate(spearmans), np.concatenate(pearsons)
+
+
+def subtract_columns(data_column, base_column):
+    """
+    Subtracts the effect of base_column from data_column via partial
+    correlation; the result only contains the words shared by the two.
 
     See http://math.bme.hu/~koitomi/statprog2011osznegyedikgyak.html.
     """
-    ld, lb, common_keys = common_dicts(data_dict, base_dict)
-    vd = np.array(map(itemgetter(1), ld))
-    vb = np.array(map(itemgetter(1), lb))
+    (vd, md), (vb, mb) = data_column, base_column
+    common = md & mb
+    values = np.zeros(len(vd))
+    values[common] = subtract_vectors(vd[common], vb[common])
+    return values, common
+
+
+def subtract_vectors(vd, vb):
+    """subtract_columns for two aligned count vectors."""
     slope, intercept, _, _, _ = linregress(vb, vd)
     vdiff = vd - (vb * slope + intercept)
     vmin = np.min(np.min(vdiff), 0)  # Get rid of negative numbers (for KL)
-    return {ld[i][0]: vdiff[i] - vmin + 0.001 for i in xrange(len(ld))}
+    return vdiff - vmin + 0.001
 
 
 def ffloat(f):
@@ -101,16 +180,25 @@ def ffloat(f):
 
 
 if __name__ == '__main__':
-    dict_file1, dict_file2, lower, dict_file_partials = parse_arguments()
-    dict1 = read_dict_file(dict_file1, lower)
-    dict2 = read_dict_file(dict_file2, lower)
+    (dict_file1, dict_file2, lower, dict_file_partials, bootstrap,
+     confidence) = parse_arguments()
+    table = CountTable([dict_file1, dict_file2] + dict_file_partials, lower)
+    column1 = table.column(dict_file1)
+    column2 = table.column(dict_file2)
     for dict_file_partial in dict_file_partials:
-        dict_partial = read_dict_file(dict_file_partial, lower)
-        dict1 = subtract_dict(dict1, dict_partial)
-        dict2 = subtract_dict(dict2, dict_partial)
-    d = compare_dicts(dict1, dict2)
-    print 'words 1 & words 2 & shared words & Spearman & Pearson & KL & JS & cos & Cohen \\\\'
-    print '{} & {} & {} & {} & {} & {} & {} & {} & {} \\\\'.format(
+        column1 = subtract_columns(column1, table.column(dict_file_partial))
+        column2 = subtract_columns(column2, table.column(dict_file_partial))
+    d = compare_columns(column1, column2, bootstrap, confidence)
+    header = 'words 1 & words 2 & shared words & Spearman & Pearson & KL & JS & cos & Cohen'
+    row = '{} & {} & {} & {} & {} & {} & {} & {} & {}'.format(
         d['dict1'], d['dict2'], d['common'],
         '{} @ {}'.format(*map(ffloat, d['spearman'])),
         '{} @ {}'.format(*map(ffloat, d['pearson'])), ffloat(d['kl']), ffloat(d['js']), ffloat(d['cos']), ffloat(d['kappa']))
+    if bootstrap > 0:
+        header += ' & Spearman {0:g}\\% CI & Pearson {0:g}\\% CI'.format(
+            100 * confidence)
+        row += ' & {} & {}'.format(
+            '[{}, {}]'.format(*map(ffloat, d['spearman_ci'])),
+            '[{}, {}]'.format(*map(ffloat, d['pearson_ci'])))
+    print header + ' \\\\'
+    print row + ' \\\\'
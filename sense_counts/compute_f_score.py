@@ -8,6 +8,14 @@ from multiprocessing import Pool
 import os
 import re
 
+import numpy as np
+
+from count_files import read_count_arrays
+
+# The dictionary of the parent process as (sorted keys, gold mask); forked
+# workers share it instead of re-reading it for every embedding.
+_dictionary = None
+
 
 def parse_arguments():
     parser = ArgumentParser(
@@ -26,36 +34,24 @@ def parse_arguments():
     return args.dictionary, args.lower, args.processes, args.embeddings
 
 
-def read_dict_file(dict_file, lower):
-    def _lower(s):
-        return s.lower() if lower else s
-    with open(dict_file) as inf:
-        return {_lower(k): float(v) for k, v in
-                (line.strip().split("\t") for line in inf)}
-
-
-def common_dicts(dict1, dict2):
-    """
-    Return the parts of dict1 and dict2 that correspond to the common keys in
-    both as lists of tuples.
-    """
-    common_keys = dict1.viewkeys() & dict2.viewkeys()
-    d1 = {k: v for k, v in dict1.iteritems() if k in common_keys}
-    d2 = {k: v for k, v in dict2.iteritems() if k in common_keys}
-    return d1, d2, common_keys
-
-
-def rate_embedding(embedding_file, dict_file, lower):
-    dictionary, embedding, _ = common_dicts(
-        read_dict_file(dict_file, lower), read_dict_file(embedding_file, lower))
-
-    gold = {k for k, v in dictionary.iteritems() if v > 1}
-    positives = {k for k, v in embedding.iteritems() if v > 1}
-    negatives = {k for k, v in embedding.iteritems() if v <= 1}
-    tp = float(len(gold & positives))
-    fp = float(len(positives - gold))
-    fn = float(len(negatives & gold))
-    #tn = float(len(negatives - gold))
+def load_dictionary(dict_file, lower):
+    global _dictionary
+    keys, values = read_count_arrays(dict_file, lower)
+    _dictionary = keys, values > 1
+
+
+def rate_embedding(embedding_file, lower):
+    """Scores an embedding against the dictionary on their common words."""
+    dict_keys, gold = _dictionary
+    keys, values = read_count_arrays(embedding_file, lower)
+    positions = np.searchsorted(dict_keys, keys)
+    found = positions < len(dict_keys)
+    found[found] = dict_keys[positions[found]] == keys[found]
+    gold = gold[positions[found]]
+    positives = values[found] > 1
+    tp = float(np.sum(gold & positives))
+    fp = float(np.sum(positives & ~gold))
+    fn = float(np.sum(~positives & gold))
     precision = tp / (tp + fp) if tp + fp > 0 else 1.0
     recall = tp / (tp + fn) if tp + fn > 0 else 1.0
     f1_score = 2 * tp / (2 * tp + fn + fp)
@@ -81,10 +77,10 @@ def print_latex_table(data, dict_file):
 
 def main():
     (dict_file, lower, processes, embedding_files) = parse_arguments()
+    load_dictionary(dict_file, lower)
     p = Pool(min(processes, len(embedding_files)))
     input_files = sorted(embedding_files)
-    res = p.map(partial(rate_embedding, dict_file=dict_file, lower=lower),
-                input_files)
+    res = p.map(partial(rate_embedding, lower=lower), input_files)
     print_latex_table(zip(input_files, res), dict_file)
 
 
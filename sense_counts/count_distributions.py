@@ -5,10 +5,13 @@
 from argparse import ArgumentParser
 from collections import Counter
 from functools import partial
-from itertools import groupby
 from multiprocessing import Pool
 import os
 
+import numpy as np
+
+from count_files import read_count_arrays
+
 
 def parse_arguments():
     parser = ArgumentParser(
@@ -26,24 +29,14 @@ def parse_arguments():
     return args.max_senses, args.processes, args.resources
 
 
-def read_dict_file(dict_file, lower=False):
-    def _lower(s):
-        return s.lower() if lower else s
-    with open(dict_file) as inf:
-        return {_lower(k): float(v) for k, v in
-                (line.strip().split("\t") for line in inf)}
-
-
 def count_senses(resource, max_senses):
-    counts = {word: round(senses) for word, senses in
-              read_dict_file(resource).iteritems()}
+    _, counts = read_count_arrays(resource)
+    # round() rounds halves away from zero, unlike np.round
+    senses = np.sign(counts) * np.floor(np.abs(counts.astype(float)) + 0.5)
     cnt = Counter({k + 1: 0 for k in xrange(max_senses)})
-    for sense, grp in groupby(sorted(counts.values())):
-        if sense > 0:
-            if sense < max_senses:
-                cnt[sense] = len(list(grp))
-            else:
-                cnt[max_senses] += len(list(grp))
+    for sense in xrange(1, max_senses):
+        cnt[sense] = int(np.sum(senses == sense))
+    cnt[max_senses] = int(np.sum(senses >= max_senses))
     return {resource: cnt}
 
 
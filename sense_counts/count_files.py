@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+
+"""
+Reads the word <TAB> count files used by the evaluation scripts.
+
+The first time a file is read, it is parsed and saved next to itself as
+<file>.counts.npz: the sorted vocabulary and its float32 counts, both as-is
+and lowercased (later lines win if a word occurs more than once, as in a dict
+built from the file). Later reads load that cache unless the size or mtime of
+the file has changed.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from embedding_io import cached_arrays
+
+
+def cache_file(dict_file):
+    return '{}.counts.npz'.format(dict_file)
+
+
+def unique_last(keys, values):
+    """The sorted unique keys and the values of their last occurrences."""
+    reverse_keys = keys[::-1]
+    unique_keys, reverse_index = np.unique(reverse_keys, return_index=True)
+    return unique_keys, values[::-1][reverse_index]
+
+
+def parse_count_file(dict_file):
+    """Parses dict_file into the arrays of its cache."""
+    with open(dict_file) as inf:
+        keys, values = zip(*(line.strip().split("\t") for line in inf)) or \
+            ((), ())
+    keys = np.array(keys, dtype=str)
+    values = np.array(values, dtype=np.float32)
+    arrays = {}
+    arrays['keys'], arrays['counts'] = unique_last(keys, values)
+    arrays['lower_keys'], arrays['lower_counts'] = unique_last(
+        np.char.lower(keys), values)
+    return arrays
+
+
+def read_count_arrays(dict_file, lower=False):
+    """
+    Returns the sorted vocabulary of a count file and the counts of the words
+    (lowercased if lower is True).
+    """
+    arrays = cached_arrays(dict_file, cache_file(dict_file), parse_count_file)
+    if lower:
+        return arrays['lower_keys'], arrays['lower_counts']
+    else:
+        return arrays['keys'], arrays['counts']
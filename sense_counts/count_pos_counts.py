@@ -3,25 +3,109 @@
 """
 Counts how many POS senses a word has -- we use perplexity so that the errors
 / insignificant usage patterns do not influence the result too much.
+
+The POS frequency data is parsed into a CSR word x POS count matrix the first
+time it is read and saved next to the input as <file>.pos.npz; later reads
+load that cache unless the size or mtime of the file has changed.
 """
 
 from argparse import ArgumentParser
 import json
+from math import log
+import os
+import sys
+
+import numpy as np
+from scipy.special import entr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from count_files import unique_last
+from embedding_io import cached_arrays
+
+
+def cache_file(pos_file):
+    return '{}.pos.npz'.format(pos_file)
+
+
+def parse_pos_file(pos_file):
+    """Parses pos_file into the arrays of its cache."""
+    words, lengths, tag_ids, counts = [], [], [], []
+    tag_index = {}
+    with open(pos_file) as inf:
+        for line in inf:
+            word, json_freqs = line.rstrip().split("\t")
+            freqs = json.loads(json_freqs)
+            words.append(word)
+            lengths.append(len(freqs))
+            for tag, freq in freqs.iteritems():
+                tag_ids.append(tag_index.setdefault(tag, len(tag_index)))
+                counts.append(freq)
+    tags = [None] * len(tag_index)
+    for tag, i in tag_index.iteritems():
+        tags[i] = tag
+    arrays = {'words': np.array(words, dtype=str),
+              'tags': np.array([tag.encode('utf-8') for tag in tags],
+                               dtype=str),
+              'tag_ids': np.array(tag_ids, dtype=np.int32),
+              'counts': np.array(counts, dtype=np.float64),
+              'offsets': np.zeros(len(words) + 1, dtype=np.int64)}
+    np.cumsum(lengths, out=arrays['offsets'][1:])
+    return arrays
+
+
+def read_pos_matrix(pos_file):
+    """
+    Returns the words of pos_file in file order, and the offsets, POS IDs and
+    frequencies of their rows in the word x POS matrix.
+    """
+    arrays = cached_arrays(pos_file, cache_file(pos_file), parse_pos_file)
+    return (arrays['words'], arrays['offsets'], arrays['tag_ids'],
+            arrays['counts'])
+
+
+def row_sums(values, offsets):
+    """
+    The sums of the CSR rows of values. The rows of the same length are summed
+    together as a dense matrix, so the results are the same as those of
+    np.sum on each row.
+    """
+    lengths = np.diff(offsets)
+    sums = np.zeros(len(lengths))
+    for length in np.unique(lengths[lengths > 0]):
+        rows = np.flatnonzero(lengths == length)
+        cells = offsets[rows][:, np.newaxis] + np.arange(length)
+        sums[rows] = values[cells].sum(axis=1)
+    return sums
 
-from scipy.stats import entropy
 
-def perplexity(distribution):
-    return pow(2, entropy(distribution, base=2))
+def perplexities(offsets, counts):
+    """2 ** the entropy (in bits) of the distribution in each row."""
+    totals = row_sums(counts, offsets)
+    probs = 1.0 * counts / np.repeat(totals, np.diff(offsets))
+    return 2 ** (row_sums(entr(probs), offsets) / log(2))
 
 
-def read_pos_data(pos_freq_data, threshold=0):
-    data = {}
-    for line in pos_freq_data:
-        word, json_freqs = line.rstrip().split("\t")
-        freqs = json.loads(json_freqs)
-        if word and sum(freqs.values()) > threshold:
-            data[word] = freqs
-    return data
+def read_pos_data(pos_file, threshold=None):
+    """
+    Returns the words above the frequency threshold in sorted order, with the
+    offsets and the frequencies of their rows. If a word occurs in more than
+    one line, the last line that is above the threshold is used.
+    """
+    words, offsets, _, counts = read_pos_matrix(pos_file)
+    totals = row_sums(counts, offsets)
+    keep = words != ''
+    if threshold is not None:
+        keep &= totals > threshold
+    rows = np.flatnonzero(keep)
+    words, rows = unique_last(words[rows], rows)
+    starts, ends = offsets[rows], offsets[rows + 1]
+    lengths = ends - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    cells = (np.arange(new_offsets[-1]) -
+             np.repeat(new_offsets[:-1] - starts, lengths))
+    return words, new_offsets, counts[cells]
 
 
 def parse_arguments():
@@ -29,7 +113,7 @@ def parse_arguments():
         description='Counts how many POS senses a word has -- we use '
                     'perplexity so that the errors / insignificant usage '
                     'patterns do not influence the result too much.')
-    parser.add_argument('pos_freq_data', type=open,
+    parser.add_argument('pos_freq_data',
                         help='The input file that lists the POS frequencies '
                              'for each word. The format is word <TAB> '
                              '<JSON dump of the POS->frequency dict>.')
@@ -42,6 +126,6 @@ def parse_arguments():
 
 if __name__ == '__main__':
     pos_freq_data, threshold = parse_arguments()
-    data = read_pos_data(pos_freq_data, threshold)
-    for word, freqs in sorted(data.iteritems()):
-        print '{}\t{}'.format(word, perplexity(freqs.values()))
+    words, offsets, counts = read_pos_data(pos_freq_data, threshold)
+    for word, word_perplexity in zip(words, perplexities(offsets, counts)):
+        print '{}\t{}'.format(word, word_perplexity)
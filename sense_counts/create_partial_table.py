@@ -7,9 +7,12 @@ from functools import partial
 from itertools import product
 from multiprocessing import Pool
 import os
-from subprocess import check_output
 
-#from .compare_sense_counts import read_dict_file
+from compare_sense_counts import (compare_columns, CountTable, ffloat,
+                                  subtract_columns)
+
+# The count table of the parent process; forked workers share it read-only.
+_table = None
 
 
 def parse_arguments():
@@ -35,15 +38,18 @@ def parse_arguments():
             args.processes, args.embeddings)
 
 
-def run_compare(base_embedding_files, script_file, dict_file, lower):
-    """Runs the comparison by invoking compare_sense_counts.py."""
+def run_compare(base_embedding_files, dict_file):
+    """Compares an embedding to the dictionary in the shared count table."""
     base_file, embedding_file = base_embedding_files
-    output = check_output([script_file] + (['-l'] if lower else []) +
-                          (['-p', base_file] if base_file else []) +
-                          [dict_file, embedding_file])
-    fields = output.split("\n")[1].split(' & ')
+    dict_column = _table.column(dict_file)
+    embedding_column = _table.column(embedding_file)
+    if base_file:
+        dict_column = subtract_columns(dict_column, _table.column(base_file))
+        embedding_column = subtract_columns(embedding_column,
+                                            _table.column(base_file))
+    d = compare_columns(dict_column, embedding_column)
     return {embedding_file:
-            {base_file: [f.split(' @ ')[0] for f in fields[3: 5]]}}
+            {base_file: [ffloat(d['spearman'][0]), ffloat(d['pearson'][0])]}}
 
 
 def recursive_update(dict1, dict2):
@@ -95,14 +101,17 @@ def print_latex_table(table, dict_file, bases):
 def main():
     (dict_file, base_files, lower,
      output_format, processes, embedding_files) = parse_arguments()
+    global _table
+    base_files = base_files or []
+    _table = CountTable([dict_file] + base_files + embedding_files, lower)
     base_files.insert(0, '')  # the vanilla case
     input_list = list(product(base_files, embedding_files))
-    p = Pool(min(processes, len(input_list)))
-    script_file = os.path.join(os.path.dirname(__file__),
-                               'compare_sense_counts.py')
-    fn = partial(run_compare, script_file=script_file, dict_file=dict_file,
-                 lower=lower)
-    dicts = p.map(fn, input_list)
+    fn = partial(run_compare, dict_file=dict_file)
+    if processes > 1:
+        p = Pool(min(processes, len(input_list)))
+        dicts = p.map(fn, input_list)
+    else:
+        dicts = map(fn, input_list)
     table = reduce(recursive_update, dicts)
     if output_format == 'latex':
         print_latex_table(table, dict_file, base_files)
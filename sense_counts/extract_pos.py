@@ -1,23 +1,152 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+"""
+Extracts the POS frequencies of the words in a word_TAG tagged corpus read
+from stdin. For each word, the most frequent first, prints
+
+    word <TAB> tag <TAB> freq <TAB> tag <TAB> freq ...
+
+to stdout and word <TAB> the perplexity of its POS distribution to stderr.
+
+Blocks of lines are counted by a pool of processes. The words and tags are
+interned into integer IDs, and the (word, tag) counts are kept in arrays
+keyed by word_id << 32 | tag_id that are merged with np.unique.
+"""
+
+from argparse import ArgumentParser
+from itertools import imap
+from multiprocessing import Pool
 import sys
-from collections import defaultdict
-from itertools import chain
-import numpy
-
-V = defaultdict(lambda: defaultdict(lambda: 0))
-
-for line in sys.stdin:
-    line = line.strip().split()
-    for w in line:
-        ww = w.split('_')
-        if len(ww) < 2:
-            continue
-        V["_".join(ww[:-1])][ww[-1]] += 1
-
-V = list(V.iteritems())
-V.sort(key=lambda x: sum(f for y,f in x[1].iteritems()), reverse=True)
-
-for w, poses in V:
-    print w + "\t" + "\t".join(map(str, chain(*poses.iteritems())))
-    numbers = numpy.array(poses.values(), dtype=float)
-    numbers /= numbers.sum()
-    print >>sys.stderr, w + "\t" + str(2**(-(numbers * numpy.log2(numbers))).sum())
\ No newline at end of file
+
+import numpy as np
+
+
+def parse_arguments():
+    parser = ArgumentParser(
+        description='Extracts the POS frequencies of the words in a tagged '
+                    'corpus (word_TAG tokens) read from stdin.')
+    parser.add_argument('--processes', '-p', type=int, default=1,
+                        help='the number of processes that count the blocks '
+                             'of the input.')
+    args = parser.parse_args()
+
+    return args.processes
+
+
+def count_block(lines):
+    """Returns the words, tags and frequencies of the tokens in lines."""
+    freqs = {}
+    for line in lines:
+        for token in line.split():
+            freqs[token] = freqs.get(token, 0) + 1
+    words, tags, counts = [], [], []
+    for token, freq in freqs.iteritems():
+        word, sep, tag = token.rpartition('_')
+        if sep:
+            words.append(word)
+            tags.append(tag)
+            counts.append(freq)
+    return words, tags, counts
+
+
+def iter_blocks(infile, block_bytes=1 << 22):
+    while True:
+        lines = infile.readlines(block_bytes)
+        if not lines:
+            return
+        yield lines
+
+
+class PairCounter():
+    """Counts (word, tag) pairs in arrays keyed by interned IDs."""
+    def __init__(self, compact_size=1 << 24):
+        self.word_ids, self.words = {}, []
+        self.tag_ids, self.tags = {}, []
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+        self.compact_size = compact_size
+
+    @staticmethod
+    def intern(ids, table, values):
+        result = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            result[i] = ids.get(value, -1)
+            if result[i] < 0:
+                result[i] = ids[value] = len(table)
+                table.append(value)
+        return result
+
+    def add(self, words, tags, counts):
+        keys = (self.intern(self.word_ids, self.words, words) << 32 |
+                self.intern(self.tag_ids, self.tags, tags))
+        self.pending.append((keys, np.array(counts, dtype=np.int64)))
+        self.pending_size += len(keys)
+        if self.pending_size > self.compact_size:
+            self.compact()
+
+    def compact(self):
+        """Merges the pending counts into the sorted key and count arrays."""
+        keys, counts = zip(*([(self.keys, self.counts)] + self.pending))
+        self.keys, inverse = np.unique(np.concatenate(keys),
+                                       return_inverse=True)
+        self.counts = np.bincount(inverse, np.concatenate(counts)).astype(
+            np.int64)
+        self.pending, self.pending_size = [], 0
+
+    def word_tag_matrix(self):
+        """
+        Returns the rows of the word x tag count matrix in CSR form, most
+        frequent word first: the word IDs, the offsets of the rows and the
+        tag IDs and counts in them.
+        """
+        self.compact()
+        word_ids, tag_ids = self.keys >> 32, self.keys & 0xffffffff
+        totals = np.bincount(word_ids, self.counts, minlength=len(self.words))
+        order = np.argsort(-totals, kind='mergesort')
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        entries = np.lexsort((tag_ids, ranks[word_ids]))
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(word_ids, minlength=len(self.words))[order],
+                  out=offsets[1:])
+        return order, offsets, tag_ids[entries], self.counts[entries]
+
+
+def perplexities(offsets, counts):
+    """The perplexity of the distribution in each CSR row of counts."""
+    totals = np.add.reduceat(counts, offsets[:-1]).astype(float)
+    probs = counts / np.repeat(totals, np.diff(offsets))
+    return 2 ** np.add.reduceat(-(probs * np.log2(probs)), offsets[:-1])
+
+
+def main():
+    processes = parse_arguments()
+    counter = PairCounter()
+    if processes > 1:
+        pool = Pool(processes)
+        block_counts = pool.imap_unordered(count_block, iter_blocks(sys.stdin))
+    else:
+        block_counts = imap(count_block, iter_blocks(sys.stdin))
+    for words, tags, counts in block_counts:
+        counter.add(words, tags, counts)
+    if processes > 1:
+        pool.close()
+        pool.join()
+
+    word_ids, offsets, tag_ids, counts = counter.word_tag_matrix()
+    if len(word_ids) == 0:
+        return
+    word_pps = perplexities(offsets, counts)
+    for i, word_id in enumerate(word_ids):
+        word = counter.words[word_id]
+        start, end = offsets[i], offsets[i + 1]
+        sys.stdout.write(word + "\t" + "\t".join(
+            counter.tags[tag_id] + "\t" + str(count) for tag_id, count
+            in zip(tag_ids[start:end], counts[start:end])) + "\n")
+        sys.stderr.write(word + "\t" + str(word_pps[i]) + "\n")
+
+
+if __name__ == '__main__':
+    main()
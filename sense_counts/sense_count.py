@@ -3,42 +3,66 @@
 """Counts the number of real senses per word in the CMultiVec output."""
 
 from argparse import ArgumentParser
-import gzip
+from functools import partial
+from itertools import islice, product
+from multiprocessing import Pool
+import os
 import sys
 
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from embedding_io import (iter_parsed_chunks, open_file, read_vectors,
+                          source_stamp)
+from sense_matrix import SenseMatrix
+
 
 def parse_arguments():
     parser = ArgumentParser(description='Counts the number of real senses per '
                                         'word in the CMultiVec output.')
     parser.add_argument('embedding', help='The multiembedding file.')
     parser.add_argument('--format', '-f',
-                        choices=['neelakantan', 'cmultivec', 'mse', 'mseh'],
-                        help='The embedding format.')
+                        choices=['neelakantan', 'cmultivec', 'mse', 'mseh',
+                                 'bin'],
+                        help='The embedding format (bin: mse in the binary '
+                             'word2vec format).')
     parser.add_argument('--centers-per-word', '-c', default=5, type=int,
                         help='The number of senses per word. Need to specify '
                              'for cmultivec.')
     parser.add_argument('--vocab', '-v', help='The vocabulary. Need to specify '
                         'for cmultivec.')
-    parser.add_argument('--zero-threshold', '-z', default=0, type=float,
+    parser.add_argument('--zero-threshold', '-z', default=[0], type=float,
+                        nargs='+',
                         help='If the vector norm falls below this, the sense '
                              'is thrown away.')
-    parser.add_argument('--similarity-threshold', '-s', default=1, type=float,
+    parser.add_argument('--similarity-threshold', '-s', default=[1],
+                        type=float, nargs='+',
                         help='If the vectors that correspond to two senses are '
                              'closer than this number (in the cosine '
-                             'similarity sense), only one of them is kept.')
+                             'similarity sense), only one of them is kept. '
+                             'If more zero and/or similarity thresholds are '
+                             'given, the counts for all combinations are '
+                             'computed in one pass.')
+    parser.add_argument('--sweep-dir', '-d',
+                        help='Write the counts of each threshold combination '
+                             'to a separate file in this directory (created '
+                             'if it does not exist) instead of printing a '
+                             'table with a column for each.')
+    parser.add_argument('--processes', '-p', type=int, default=1,
+                        help='the number of processes that count senses '
+                             'parallel.')
+    parser.add_argument('--csr-cache', action='store_true',
+                        help='Read the whole embedding into a sense matrix '
+                             'and save it next to the embedding '
+                             '(<embedding>.<format>.csr.npz and '
+                             '.csr-vecs.npy); later runs read the senses '
+                             'from there instead of parsing the embedding.')
     args = parser.parse_args()
 
     return (args.embedding, args.format, args.centers_per_word, args.vocab,
-            args.zero_threshold, args.similarity_threshold)
-
-
-def open_file(file_name, mode='r'):
-    if file_name.endswith('.gz'):
-        return gzip.open(file_name, mode)
-    else:
-        return open(file_name, mode)
+            args.zero_threshold, args.similarity_threshold, args.processes,
+            args.sweep_dir, args.csr_cache)
 
 
 def read_neelakantan(nk_file):
@@ -56,76 +80,243 @@ def read_neelakantan(nk_file):
                 for _ in xrange(int(senses)):
                     for _ in xrange(vec_per_sense - 1):
                         inf.readline()  # "word sense vector"
-                    centers.append([float(n) for n in inf.readline().strip().split()])
+                    centers.append(np.fromstring(inf.readline(),
+                                                 dtype='float64', sep=' '))
                 if word_no % 5000 == 0 and word_no > 0:
                     print >>sys.stderr, "Read", word_no, "words."
-                yield token, centers
+                yield token, np.array(centers)
             except:
                 print >>sys.stderr, "Error in line >{}<".format(line)
                 raise
     print >> sys.stderr, "Done."
 
 
-def read_cmultivec(center_file, vocab_file):
+def read_cmultivec(center_file, vocab_file, processes=None):
     """CMultiVec format with separate vocabulary and centroid files."""
-    with open_file(vocab_file) as vocabf, open_file(center_file) as centerf:
-        word, centers = None, []
-        for word_no, v_l in enumerate(vocabf):
-            token = v_l.strip()[2:]
-            vector = [float(n) for n in centerf.readline().strip().split()]
-            if token != word:
-                if word:
-                    yield word, np.array(centers)
-                word, centers = token, []
-            centers.append(vector)
-            if word_no % 5000 == 0 and word_no > 0:
-                print >>sys.stderr, "Read", word_no, "words."
-        if word:
-            yield word, np.array(centers)
+    with open_file(vocab_file) as vocabf:
+        tokens = (v_l.strip()[2:] for v_l in vocabf)
+        for word, centers in group_senses(zip_blocks(
+                tokens, iter_parsed_chunks(center_file, header=False,
+                                           words=False, processes=processes,
+                                           dtype='float64'))):
+            yield word, centers
     print >> sys.stderr, "Done."
 
 
-def read_mse(mse_file, header):
-    with open_file(mse_file) as inf:
-        word, centers = None, []
-        if header:
-            inf.readline()
-        for line in inf:
-            fields = line.strip().split()
-            token, vector = fields[0], [float(n) for n in fields[1:]]
-            if token != word:
-                if word:
-                    yield word, np.array(centers)
-                word, centers = token, []
-            centers.append(vector)
-        if word:
-            yield word, np.array(centers)
+def zip_blocks(tokens, blocks):
+    """
+    Pairs the vector blocks with the next tokens; stops when either of them
+    runs out.
+    """
+    for _, vectors in blocks:
+        block_tokens = list(islice(tokens, len(vectors)))
+        if block_tokens:
+            yield block_tokens, vectors[:len(block_tokens)]
+        if len(block_tokens) < len(vectors):
+            return
 
 
-def filter_senses(centers, zero_threshold, max_distance):
-    """Filters centers that are too close to zero or to one another."""
-    dist_to_zero = np.linalg.norm(centers, axis=1)
-    norm_centers = centers / np.where(dist_to_zero != 0, dist_to_zero, 1)[:, np.newaxis]
-    norm_centers = norm_centers[dist_to_zero >= zero_threshold]
-    dists = norm_centers.dot(norm_centers.T)
-    dists[np.eye(dists.shape[0]) == 1] = -1
-    dists = dists >= max_distance
-    for i in xrange(dists.shape[0] - 1, -1, -1):
-        if any(dists[i]):
-            dists = np.delete(np.delete(dists, i, 0), i, 1)
-            centers = np.delete(centers, i, 0)
-    return centers
+def read_mse(mse_file, header, processes=None):
+    return group_senses(iter_parsed_chunks(mse_file, header,
+                                           processes=processes,
+                                           dtype='float64'))
 
 
-if __name__ == '__main__':
-    (embedding_file, eformat, centers_per_word, vocab_file,
-     zero_threshold, similarity_threshold) = parse_arguments()
+def read_sense_matrix(embedding_file, eformat, vocab_file=None,
+                      processes=None):
+    """Reads an embedding of any of the formats into a SenseMatrix."""
     if eformat == 'neelakantan':
-        gen = read_neelakantan(embedding_file)
+        return SenseMatrix.from_groups(read_neelakantan(embedding_file))
     elif eformat == 'cmultivec':
-        gen = read_cmultivec(embedding_file, vocab_file)
+        with open_file(vocab_file) as vocabf:
+            tokens = [v_l.strip()[2:] for v_l in vocabf]
+        _, vectors = read_vectors(embedding_file, header=False, words=False,
+                                  processes=processes, dtype='float64')
+        return SenseMatrix.from_rows(tokens, vectors[:len(tokens)])
     elif eformat.startswith('mse'):
-        gen = read_mse(embedding_file, header=eformat=='mse')
+        words, vectors = read_vectors(embedding_file, header=eformat == 'mse',
+                                      processes=processes, dtype='float64')
+        return SenseMatrix.from_rows(words, vectors)
+    elif eformat == 'bin':
+        return SenseMatrix.from_rows(*read_vectors(
+            embedding_file, processes=processes, binary=True))
+
+
+def load_sense_matrix(embedding_file, eformat, vocab_file=None,
+                      processes=None):
+    """
+    Like read_sense_matrix, but the matrix is cached next to the embedding
+    and only rebuilt if the embedding (or the vocabulary) has changed.
+    """
+    cache_base = '{}.{}'.format(embedding_file, eformat)
+    sources = [embedding_file] + ([vocab_file] if eformat == 'cmultivec'
+                                  else [])
+    stamp = np.concatenate([source_stamp(filen) for filen in sources])
+    senses = SenseMatrix.load(cache_base, stamp)
+    if senses is None:
+        senses = read_sense_matrix(embedding_file, eformat, vocab_file,
+                                   processes)
+        senses.save(cache_base, stamp)
+    return senses
+
+
+def group_senses(blocks):
+    """
+    Groups the rows of (words, vectors) blocks into (word, centers) pairs;
+    the senses of a word are on consecutive rows.
+    """
+    word, parts = None, []
+    for words, vectors in blocks:
+        if not words:
+            continue
+        bounds = [i for i in xrange(1, len(words)) if words[i] != words[i - 1]]
+        for start, end in zip([0] + bounds, bounds + [len(words)]):
+            if words[start] != word:
+                if word:
+                    yield word, np.vstack(parts)
+                word, parts = words[start], []
+            parts.append(vectors[start:end])
+    if word:
+        yield word, np.vstack(parts)
+
+
+def filter_senses(centers, zero_threshold, max_distance):
+    """Filters centers that are too close to one another."""
+    keep = filter_senses_batch(SenseMatrix.from_groups([(None, centers)]),
+                               zero_threshold, max_distance)
+    return np.asarray(centers)[keep]
+
+
+def filter_senses_batch(senses, zero_threshold, max_distance):
+    """
+    Returns a mask of the rows of a SenseMatrix that are kept. Going from the
+    last sense of a word to the first, a sense is dropped if its cosine
+    similarity to any other remaining sense of the word is at least
+    max_distance. Senses whose norm is below zero_threshold are not compared
+    to the others, but they are kept (as has always been the case).
+    """
+    return filter_senses_sweep(senses, [zero_threshold], [max_distance])[0]
+
+
+def filter_senses_sweep(senses, zero_thresholds, max_distances):
+    """
+    Like filter_senses_batch, but for all (zero_threshold, max_distance)
+    combinations, in the order of itertools.product; returns a
+    (combinations x senses) mask. The norms and similarities are only
+    computed once.
+
+    The words are processed in groups of the same number of senses: the
+    similarities of a group come from a single batched matmul of a
+    (words x senses x dim) tensor, and the greedy deduplication is done
+    position by position on boolean masks of the whole group.
+    """
+    settings = list(product(zero_thresholds, max_distances))
+    # in float32, the cosine of two parallel senses can exceed 1, which
+    # would drop them at the default max_distance of 1
+    vecs = np.asarray(senses.vecs, dtype='float64')
+    dist_to_zero = np.linalg.norm(vecs, axis=1) if len(vecs) else np.zeros(0)
+    norm_vecs = vecs / np.where(dist_to_zero != 0, dist_to_zero, 1)[:, np.newaxis]
+    keep = np.ones((len(settings), len(vecs)), dtype=bool)
+    counts = senses.sense_counts()
+    for n in np.unique(counts[counts > 1]):
+        rows = (senses.offsets[:-1][counts == n][:, np.newaxis] +
+                np.arange(n))
+        group = norm_vecs[rows]
+        sims = np.matmul(group, group.transpose(0, 2, 1))
+        sims[:, np.arange(n), np.arange(n)] = -np.inf
+        for setting, (zero_threshold, max_distance) in enumerate(settings):
+            similar = sims >= max_distance
+            alive = dist_to_zero[rows] >= zero_threshold
+            for i in xrange(n - 1, -1, -1):
+                dup = alive[:, i] & (similar[:, i, :] & alive).any(axis=1)
+                alive[:, i] &= ~dup
+                keep[setting, rows[:, i]] = ~dup
+    return keep
+
+
+def count_senses(senses, zero_threshold, max_distance):
+    """The words of a SenseMatrix and the number of senses kept for each."""
+    words, counts = count_senses_sweep(senses, [zero_threshold],
+                                       [max_distance])
+    return words, counts[:, 0]
+
+
+def count_senses_sweep(senses, zero_thresholds, max_distances):
+    """
+    The words of a SenseMatrix and a (words x combinations) matrix of the
+    number of senses kept for each threshold combination.
+    """
+    keep = filter_senses_sweep(senses, zero_thresholds, max_distances)
+    kept_before = np.hstack([np.zeros((len(keep), 1), dtype=int),
+                             np.cumsum(keep, axis=1)])
+    counts = (kept_before[:, senses.offsets[1:]] -
+              kept_before[:, senses.offsets[:-1]])
+    return senses.words, counts.T
+
+
+def iter_batches(gen, batch_size=10000):
+    """Groups the (word, centers) pairs of gen into SenseMatrix batches."""
+    batch = []
     for word, centers in gen:
-        senses = filter_senses(centers, zero_threshold, similarity_threshold)
-        print "{}\t{}".format(word, len(senses))
+        batch.append((word, centers))
+        if len(batch) == batch_size:
+            yield SenseMatrix.from_groups(batch)
+            batch = []
+    if batch:
+        yield SenseMatrix.from_groups(batch)
+
+
+def setting_name(zero_threshold, max_distance):
+    return 'z{}_s{}'.format(zero_threshold, max_distance)
+
+
+if __name__ == '__main__':
+    (embedding_file, eformat, centers_per_word, vocab_file,
+     zero_thresholds, similarity_thresholds, processes,
+     sweep_dir, csr_cache) = parse_arguments()
+    settings = list(product(zero_thresholds, similarity_thresholds))
+    if sweep_dir:
+        # before reading the model, so that a bad directory fails early
+        if not os.path.isdir(sweep_dir):
+            os.makedirs(sweep_dir)
+        outfs = [open(os.path.join(sweep_dir, setting_name(*setting)), 'w')
+                 for setting in settings]
+    if csr_cache:
+        senses = load_sense_matrix(embedding_file, eformat, vocab_file,
+                                   processes)
+        batches = (senses.word_range(start, start + 10000)
+                   for start in xrange(0, len(senses), 10000))
+    else:
+        if eformat == 'neelakantan':
+            gen = read_neelakantan(embedding_file)
+        elif eformat == 'cmultivec':
+            gen = read_cmultivec(embedding_file, vocab_file, processes)
+        elif eformat.startswith('mse'):
+            gen = read_mse(embedding_file, header=eformat=='mse',
+                           processes=processes)
+        elif eformat == 'bin':
+            gen = group_senses([read_vectors(
+                embedding_file, processes=processes, binary=True)])
+        batches = iter_batches(gen)
+    fn = partial(count_senses_sweep, zero_thresholds=zero_thresholds,
+                 max_distances=similarity_thresholds)
+    if processes > 1:
+        p = Pool(processes)
+        # imap keeps the order of the words
+        counted = p.imap(fn, batches)
+    else:
+        counted = (fn(senses) for senses in batches)
+    if sweep_dir:
+        for words, counts in counted:
+            for outf, column in zip(outfs, counts.T):
+                for word, count in zip(words, column):
+                    outf.write("{}\t{}\n".format(word, count))
+        for outf in outfs:
+            outf.close()
+    else:
+        if len(settings) > 1:
+            print "word\t{}".format(
+                "\t".join(setting_name(*setting) for setting in settings))
+        for words, counts in counted:
+            for word, row in zip(words, counts):
+                print "{}\t{}".format(word, "\t".join(map(str, row)))
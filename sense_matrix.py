@@ -0,0 +1,136 @@
+#coding=utf-8
+"""
+Multi-sense models grouped by headword.
+
+In the mse format, the senses of a word are on consecutive lines. A
+SenseMatrix keeps them in one contiguous matrix with an offsets array
+(as in CSR sparse matrices): the senses of the i-th headword are the rows
+offsets[i]:offsets[i + 1]. A sorted index of the headwords gives random
+access to the senses of any word, and per-word reductions are a single
+ufunc.reduceat call.
+
+Saved next to foo.mse as foo.mse.csr.npz (headwords, offsets, sorted index)
+and foo.mse.csr-vecs.npy (the senses, opened with mmap when loaded). The
+stamp given to save is stored with them; load returns None if it differs.
+"""
+
+import logging
+import os
+
+import numpy
+
+
+def csr_paths(filen):
+    return '{}.csr.npz'.format(filen), '{}.csr-vecs.npy'.format(filen)
+
+
+class SenseMatrix():
+    def __init__(self, words, offsets, vecs, sorted_inds=None):
+        self.words = numpy.asarray(words)
+        self.offsets = numpy.asarray(offsets, dtype='int64')
+        self.vecs = vecs
+        if sorted_inds is None:
+            sorted_inds = numpy.argsort(self.words, kind='mergesort')
+        self.sorted_inds = sorted_inds
+        self.sorted_words = self.words[sorted_inds]
+
+    @classmethod
+    def from_rows(cls, row_words, vecs):
+        """Groups the rows of an mse matrix with the headwords row_words."""
+        row_words = numpy.asarray(row_words)
+        if len(row_words) == 0:
+            return cls(row_words, [0], vecs)
+        starts = numpy.concatenate(
+            [[0], numpy.flatnonzero(row_words[1:] != row_words[:-1]) + 1])
+        return cls(row_words[starts], numpy.append(starts, len(row_words)),
+                   vecs)
+
+    @classmethod
+    def from_groups(cls, groups):
+        """Builds the matrix from (word, centers) pairs."""
+        words, counts, parts = [], [], []
+        for word, centers in groups:
+            words.append(word)
+            counts.append(len(centers))
+            if len(centers):
+                parts.append(numpy.asarray(centers))
+        offsets = numpy.zeros(len(words) + 1, dtype='int64')
+        numpy.cumsum(counts, out=offsets[1:])
+        vecs = (numpy.vstack(parts) if parts
+                else numpy.zeros((0, 0), dtype='float32'))
+        return cls(words, offsets, vecs)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        for i, word in enumerate(self.words):
+            yield word, self.vecs[self.offsets[i]:self.offsets[i + 1]]
+
+    def index(self, word):
+        """The position of word among the headwords, or -1."""
+        pos = numpy.searchsorted(self.sorted_words, word)
+        if pos < len(self.sorted_words) and self.sorted_words[pos] == word:
+            return self.sorted_inds[pos]
+        return -1
+
+    def senses(self, word):
+        """All sense vectors of word (an empty matrix if it is unknown)."""
+        i = self.index(word)
+        if i < 0:
+            return self.vecs[:0]
+        return self.vecs[self.offsets[i]:self.offsets[i + 1]]
+
+    def sense_counts(self):
+        return numpy.diff(self.offsets)
+
+    def reduce(self, values, ufunc=numpy.add):
+        """
+        Reduces values (one row per sense) per headword with ufunc; all
+        headwords must have at least one sense.
+        """
+        return ufunc.reduceat(values, self.offsets[:-1], axis=0)
+
+    def word_range(self, start, end):
+        """The headwords start:end and their senses as a SenseMatrix."""
+        offsets = self.offsets[start:end + 1]
+        return SenseMatrix(self.words[start:end], offsets - offsets[0],
+                           numpy.asarray(self.vecs[offsets[0]:offsets[-1]]))
+
+    def save(self, filen, stamp=None):
+        """
+        Saves the matrix next to filen; stamp (e.g. the source_stamp of the
+        files it was read from) is checked by load.
+        """
+        meta_fn, vecs_fn = csr_paths(filen)
+        try:
+            with open(vecs_fn + '.tmp', mode='wb') as outfile:
+                numpy.save(outfile, self.vecs)
+            os.rename(vecs_fn + '.tmp', vecs_fn)
+            # written last: the matrix is only valid once this exists
+            with open(meta_fn + '.tmp', mode='wb') as outfile:
+                numpy.savez(outfile, words=self.words, offsets=self.offsets,
+                            sorted_inds=self.sorted_inds,
+                            stamp=numpy.zeros(0) if stamp is None else stamp)
+            os.rename(meta_fn + '.tmp', meta_fn)
+        except (IOError, OSError) as e:
+            logging.warning('could not save sense matrix of {}: {}'.format(
+                filen, e))
+
+    @classmethod
+    def load(cls, filen, stamp=None, mmap_mode='r'):
+        """
+        Returns the matrix saved next to filen, or None if it is missing or
+        was saved with a different stamp.
+        """
+        meta_fn, vecs_fn = csr_paths(filen)
+        if not (os.path.isfile(meta_fn) and os.path.isfile(vecs_fn)):
+            return None
+        meta = numpy.load(meta_fn)
+        if stamp is not None and not numpy.array_equal(meta['stamp'], stamp):
+            logging.info('{} is stale'.format(meta_fn))
+            return None
+        logging.info('loading sense matrix from {}'.format(meta_fn))
+        return cls(meta['words'], meta['offsets'],
+                   numpy.load(vecs_fn, mmap_mode=mmap_mode),
+                   meta['sorted_inds'])
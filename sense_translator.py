@@ -3,13 +3,49 @@
 import argparse
 import logging
 from itertools import izip
+from multiprocessing import Pool
 import os
+import shutil
+import tempfile
+import time
 
 import numpy
 from scipy.spatial.distance import cdist
 from nearpy import Engine
 from nearpy.hashes import PCABinaryProjections
 
+from ann_index import ExactIndex, IVFIndex
+from embedding_io import load_embedding
+from sense_matrix import SenseMatrix
+
+# The translator of the parent process; forked workers share it read-only.
+_translator = None
+
+
+def _translate_shard(bounds):
+    """
+    Translates the source senses in the bounds of a shard into a temporary
+    file in the shard directory; returns its name, the number of senses, the
+    time it took and the number of senses without a translation.
+    """
+    start, end = bounds
+    began = time.time()
+    untranslated = 0
+    fd, tmp_fn = tempfile.mkstemp(prefix='.shard', dir=_translator.shard_dir)
+    try:
+        with os.fdopen(fd, 'w') as tmpf:
+            for batch_start in xrange(start, end, _translator.args.batch_size):
+                lines, missing = _translator.translate_batch(
+                    batch_start,
+                    min(batch_start + _translator.args.batch_size, end))
+                tmpf.writelines(lines)
+                untranslated += missing
+    except:
+        os.remove(tmp_fn)
+        raise
+    return tmp_fn, end - start, time.time() - began, untranslated
+
+
 class SenseTranslator():
     """
     Finds translations from the source VSM to the target VSM.
@@ -37,14 +73,22 @@ class SenseTranslator():
         format_ = "%(asctime)s %(module)s (%(lineno)s) %(levelname)s %(message)s"
         logging.basicConfig(level=logging.DEBUG, format=format_)
         self.parse_args()
+        self.load_models()
+        self.outfile = open(self.args.outfile, mode='w')
+
+    def load_models(self):
         logging.info(
             'reading translation mx from {}'.format(self.args.mx))
         self.mx = numpy.genfromtxt(self.args.mx)
         self.sr_vocab, self.sr_vecs = self.get_embed(self.args.sr_embed)
         self.tg_vocab, self.tg_vecs = self.get_embed(self.args.tg_embed)
-        self.sr_engine = self.get_engine(self.sr_vocab, self.sr_vecs)
-        self.tg_engine = self.get_engine(self.tg_vocab, self.tg_vecs)
-        self.outfile = open(self.args.outfile, mode='w')
+        self.sr_senses = SenseMatrix.from_rows(self.sr_vocab, self.sr_vecs)
+        if self.args.search == 'lsh':
+            self.sr_engine = self.get_engine(self.sr_vocab, self.sr_vecs)
+            self.tg_engine = self.get_engine(self.tg_vocab, self.tg_vecs)
+        else:
+            self.sr_index = self.get_index(self.args.sr_embed, self.sr_vecs)
+            self.tg_index = self.get_index(self.args.tg_embed, self.tg_vecs)
 
     def parse_args(self):
         arg_parser = argparse.ArgumentParser()
@@ -55,29 +99,37 @@ class SenseTranslator():
         arg_parser.add_argument(
             '-p', '--projections', help='number of hash functions (7--14)', type=int,
             default=8)
+        arg_parser.add_argument(
+            '-s', '--search', choices=['exact', 'ivf', 'lsh'], default='exact',
+            help='exact: batched brute-force cosine search (default); '
+                 'ivf: inverted file index saved next to the embeddings; '
+                 'lsh: per-vector nearpy lookup')
+        arg_parser.add_argument(
+            '--nlist', type=int, default=1024,
+            help='number of inverted lists in the ivf index')
+        arg_parser.add_argument(
+            '--nprobe', type=int, default=16,
+            help='number of inverted lists searched per query in ivf mode; '
+                 'higher is slower but more accurate')
+        arg_parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='number of processes translating contiguous shards of the '
+                 'source vocabulary (exact and ivf mode)')
+        arg_parser.add_argument(
+            '-b', '--batch-size', type=int, default=1024,
+            help='number of source senses searched together in exact and ivf '
+                 'mode')
         self.args = arg_parser.parse_args()
+        if self.args.workers > 1 and self.args.search == 'lsh':
+            arg_parser.error('--workers is not supported in lsh mode')
 
     def get_embed(self, filen):
         filenp, ext = os.path.splitext(filen)
         logging.info('getting embedding from {} ...'.format(filen))
         if ext in ['.w2v', '.mse']:
-            filen_npz = '{}.npz'.format(filenp)
-            if os.path.isfile(filen_npz):
-                logging.warning('embedding also available in npz format')
-            infile = open(filen)
-            header = infile.readline().strip()
-            vocab_size, dim = [int(token) for token in header.split()]
-            vocab = [line.strip().split()[0] for line in infile.readlines()]
-            if len(vocab) != vocab_size:
-                logging.warn(
-                    'vocab size is {}, header says {}'.format(len(vocab),
-                                                              vocab_size))
-            vecs = numpy.genfromtxt( 
-                open(filen).readlines()[:300001], skip_header=1,
-                usecols=numpy.arange(1,dim+1), comments=None, dtype='float32')
-            if ext == 'mse' and not os.path.isfile(filen_npz):
-                logging.info('saving embedding to {}'.format(filen_npz))
-                numpy.savez_compressed(filen_npz, vocab, vecs)
+            vocab, vecs = load_embedding(filen)
+        elif ext == '.bin':
+            vocab, vecs = load_embedding(filen, binary=True)
         elif ext == '.npz':
             vocab = numpy.load(filen)['arr_0']
             logging.debug(vocab[:10])
@@ -88,6 +140,17 @@ class SenseTranslator():
         #logging.debug('\n{}'.format(vecs))
         return vocab, vecs
 
+    def get_index(self, filen, vecs):
+        if self.args.search == 'exact':
+            return ExactIndex(vecs)
+        index = IVFIndex.load(filen, self.args.nlist, self.args.nprobe)
+        if index is None:
+            logging.info('building index with {} lists for {} ...'.format(
+                self.args.nlist, filen))
+            index = IVFIndex.build(vecs, self.args.nlist, self.args.nprobe)
+            index.save(filen)
+        return index
+
     def get_engine(self, vocab, vecs):
         logging.info('{} hash functions'.format(self.args.projections))
         hashes = [PCABinaryProjections('ne1v', self.args.projections, vecs[:1000,:].T)]
@@ -108,30 +171,110 @@ class SenseTranslator():
                               for i in inds_among_near]
         return [vocab[ind] for ind in top_indices_ranked]
 
+    def search_senses(self, sr_block):
+        """
+        Returns the indices of the source neighbors (the sense itself first)
+        and of the translations of a block of source senses, and a mask of
+        the senses that have a translation.
+        """
+        sr_block = numpy.asarray(sr_block, dtype='float32')
+        tg_block = sr_block.dot(self.mx.astype('float32'))
+        near_inds = self.sr_index.search(sr_block, 5)
+        trans_inds = self.tg_index.search(tg_block, 10)
+        translated = tg_block.any(axis=1) & (trans_inds >= 0).any(axis=1)
+        return near_inds, trans_inds, translated
+
+    def translate_batch(self, start, end):
+        """
+        Returns the dictionary lines for the source senses start:end, searching
+        both spaces with a few matrix products per batch, and the number of
+        senses without a translation (zero vectors or no candidates).
+        """
+        near_inds, trans_inds, translated = self.search_senses(
+            self.sr_vecs[start:end])
+        lines = ['{}\t{}\t{}\n'.format(
+                     hwd,
+                     ', '.join(self.sr_vocab[ind] for ind in near_row[1:]
+                               if ind >= 0),
+                     ', '.join(self.tg_vocab[ind] for ind in trans_row
+                               if ind >= 0))
+                 for hwd, near_row, trans_row, ok in izip(
+                     self.sr_vocab[start:end], near_inds, trans_inds,
+                     translated) if ok]
+        return lines, len(translated) - translated.sum()
+
     def main(self):
         logging.info('writing dictionary to {} ...'.format(self.args.outfile))
+        if self.args.search == 'lsh':
+            return self.main_lsh()
+        if self.args.workers > 1:
+            return self.main_parallel()
+        batch_size = self.args.batch_size
+        for start in xrange(0, len(self.sr_vocab), batch_size):
+            lines, untranslated = self.translate_batch(start, start + batch_size)
+            self.outfile.writelines(lines)
+            logging.info('{} words translated, except for {} ones'.format(
+                min(start + batch_size, len(self.sr_vocab)), untranslated))
+
+    def main_parallel(self):
+        """
+        Translates contiguous shards of the source vocabulary in worker
+        processes and appends their output to outfile in the original order.
+        """
+        global _translator
+        _translator = self
+        vocab_size = len(self.sr_vocab)
+        shard_size = max(1, -(-vocab_size // (self.args.workers * 4)))
+        shards = [(start, min(start + shard_size, vocab_size))
+                  for start in xrange(0, vocab_size, shard_size)]
+        # the shards that are done but not merged yet are removed with the
+        # directory if a worker fails
+        self.shard_dir = tempfile.mkdtemp(
+            prefix='.shards', dir=os.path.dirname(
+                os.path.abspath(self.args.outfile)))
+        pool = Pool(self.args.workers)
+        try:
+            for i, (tmp_fn, senses, secs, untranslated) in enumerate(
+                    pool.imap(_translate_shard, shards)):
+                with open(tmp_fn) as tmpf:
+                    shutil.copyfileobj(tmpf, self.outfile)
+                os.remove(tmp_fn)
+                logging.info(
+                    'shard {}/{}: {} senses in {:.1f}s ({:.0f}/s), {} without '
+                    'translation'.format(i + 1, len(shards), senses, secs,
+                                         senses / max(secs, 1e-6),
+                                         untranslated))
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            shutil.rmtree(self.shard_dir, ignore_errors=True)
+
+    def main_lsh(self):
         towarn = []
-        old_hwd = ''
-        for i, (hwd, sr_vec) in enumerate(izip(self.sr_vocab, self.sr_vecs)):
-            if hwd != old_hwd:
-                sense_without_trans = 0
+        for i, (hwd, sr_vecs) in enumerate(self.sr_senses):
             if not i % 1000:
                 msg = '{} words translated'.format(i)
                 if towarn:
                     msg +=', except for {} ones, e.g. {}'.format(len(towarn), ', '.join(towarn[:9]))
                 logging.info(msg)
                 towarn = []
-            try:
-                self.outfile.write('{}\t{}\t{}\n'.format(
-                    hwd, 
-                    ', '.join(self.near_words(self.sr_engine, 
-                                              sr_vec, self.sr_vocab)[1:5]),
-                    ', '.join(self.near_words(self.tg_engine,
-                                              sr_vec.dot(self.mx), self.tg_vocab))))
-            except:
-                sense_without_trans += 1
-                if sense_without_trans > 1:
-                    towarn.append(hwd)
+            sense_without_trans = 0
+            for sr_vec in sr_vecs:
+                try:
+                    self.outfile.write('{}\t{}\t{}\n'.format(
+                        hwd, 
+                        ', '.join(self.near_words(self.sr_engine, 
+                                                  sr_vec, self.sr_vocab)[1:5]),
+                        ', '.join(self.near_words(self.tg_engine,
+                                                  sr_vec.dot(self.mx), self.tg_vocab))))
+                except:
+                    sense_without_trans += 1
+            if sense_without_trans > 1:
+                towarn.append(hwd)
 
 
 if __name__ == "__main__":
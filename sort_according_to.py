@@ -1,14 +1,80 @@
+"""
+Sorts the lines of stdin by the position of their first word in a reference
+file (e.g. an embedding file in frequency order). If a word occurs more than
+once in the reference, its last position counts; lines with unknown words
+come last. The sort is stable.
+
+The reference is kept as a sorted word array with the positions, and the
+lines are sorted with an external merge sort, so the input may be larger
+than the memory. A small --memory yields many sorted runs; the sort relies
+on external_sort merging at most MAX_FAN_IN of them at once, which keeps the
+number of open files bounded.
+"""
+
+import argparse
+from itertools import islice
 import sys
-from collections import defaultdict
 
-ordering = defaultdict(lambda: sys.maxint)
+import numpy as np
+
+from external_sort import ExternalSorter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Sorts the lines of stdin by the position of their first '
+                    'word in a reference file.')
+    parser.add_argument('reference', help='the file that defines the order')
+    parser.add_argument('--memory', '-m', type=int, default=1024,
+                        help='the memory budget of the sort in MB; above it, '
+                             'sorted runs are written to disk')
+    parser.add_argument('--tmp-dir', help='the directory of the sorted runs '
+                                          '(the system default if not set)')
+    return parser.parse_args()
+
+
+def first_word(line):
+    fields = line.split(None, 1)
+    return fields[0] if fields else ''
+
+
+def read_ordering(reference):
+    """Returns the sorted words of the reference file and their positions."""
+    with open(reference) as inf:
+        words, positions = [], []
+        for i, line in enumerate(inf):
+            word = first_word(line)
+            if word:
+                words.append(word)
+                positions.append(i)
+    # np.unique keeps the first occurrence; the last one is wanted
+    words, last = np.unique(np.array(words[::-1], dtype=str),
+                            return_index=True)
+    return words, np.array(positions[::-1], dtype=np.int64)[last]
+
 
-for i, line in enumerate(open(sys.argv[1])):
-    ordering[line.strip().split()[0]] = i
+def ranks_of(lines, words, positions):
+    """The positions of the first words of lines (sys.maxint if unknown)."""
+    keys = np.array([first_word(line) for line in lines], dtype=str)
+    if not len(words):
+        return np.repeat(sys.maxint, len(keys))
+    inds = np.searchsorted(words, keys).clip(0, len(words) - 1)
+    return np.where(words[inds] == keys, positions[inds], sys.maxint)
 
-data=[]
-for line in sys.stdin:
-    data.append((line, ordering[line.strip().split()[0]]))
 
-for d in sorted(data, key=lambda x: x[1]):
-    sys.stdout.write(d[0])
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    words, positions = read_ordering(args.reference)
+    sorter = ExternalSorter(args.memory << 20, args.tmp_dir)
+    seq = 0
+    while True:
+        lines = list(islice(sys.stdin, 100000))
+        if not lines:
+            break
+        for rank, line in zip(ranks_of(lines, words, positions).tolist(),
+                              lines):
+            sorter.add((rank, seq, line))
+            seq += 1
+    for _, _, line in sorter:
+        sys.stdout.write(line)
+    sorter.close()
@@ -0,0 +1,195 @@
+#coding=utf-8
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+import json
+import logging
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+from threading import Event, Lock, Thread
+import time
+from urlparse import parse_qs, urlparse
+
+import numpy
+
+from sense_translator import SenseTranslator
+
+
+class LRUCache():
+    """A thread-safe mapping that forgets the least recently used items."""
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class Query():
+    """The source rows of a headword waiting for the batcher."""
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+
+class TranslationServer(SenseTranslator):
+    """
+    Keeps the models and indexes of SenseTranslator in memory and answers
+    translation queries over HTTP, e.g.
+
+        curl 'localhost:8765/translate?word=jelentés&word=nap'
+
+    returns, for each sense of each headword, its source neighbors and its
+    translations as JSON (null for words not in the source model). The
+    queries that arrive within --batch-window milliseconds of one another
+    are searched together, and the results of the most recently asked
+    headwords are cached.
+    """
+    def __init__(self):
+        format_ = "%(asctime)s %(module)s (%(lineno)s) %(levelname)s %(message)s"
+        logging.basicConfig(level=logging.DEBUG, format=format_)
+        self.parse_args()
+        self.load_models()
+        self.cache = LRUCache(self.args.cache_size)
+        self.queue = Queue()
+        batcher = Thread(target=self.batch_loop)
+        batcher.daemon = True
+        batcher.start()
+
+    def parse_args(self):
+        arg_parser = argparse.ArgumentParser()
+        arg_parser.add_argument('mx')
+        arg_parser.add_argument('sr_embed')
+        arg_parser.add_argument('tg_embed')
+        arg_parser.add_argument('--host', default='localhost')
+        arg_parser.add_argument('--port', type=int, default=8765)
+        arg_parser.add_argument(
+            '-s', '--search', choices=['exact', 'ivf'], default='exact',
+            help='exact: batched brute-force cosine search (default); '
+                 'ivf: inverted file index saved next to the embeddings')
+        arg_parser.add_argument(
+            '--nlist', type=int, default=1024,
+            help='number of inverted lists in the ivf index')
+        arg_parser.add_argument(
+            '--nprobe', type=int, default=16,
+            help='number of inverted lists searched per query in ivf mode; '
+                 'higher is slower but more accurate')
+        arg_parser.add_argument(
+            '-b', '--batch-size', type=int, default=1024,
+            help='maximum number of source senses searched together')
+        arg_parser.add_argument(
+            '--batch-window', type=float, default=5,
+            help='milliseconds to wait for further queries to batch')
+        arg_parser.add_argument(
+            '--cache-size', type=int, default=10000,
+            help='number of headwords whose translations are cached')
+        self.args = arg_parser.parse_args()
+
+    def batch_loop(self):
+        """Searches the senses of the queued queries in batches."""
+        while True:
+            queries = [self.queue.get()]
+            size = len(queries[0].rows)
+            deadline = time.time() + self.args.batch_window / 1000.
+            while size < self.args.batch_size:
+                try:
+                    queries.append(self.queue.get(
+                        timeout=max(deadline - time.time(), 0)))
+                    size += len(queries[-1].rows)
+                except Empty:
+                    break
+            try:
+                rows = numpy.concatenate([query.rows for query in queries])
+                near_inds, trans_inds, translated = self.search_senses(
+                    self.sr_vecs[rows])
+                offset = 0
+                for query in queries:
+                    query.result = [
+                        {'neighbours': [self.sr_vocab[ind]
+                                        for ind in near_row[1:] if ind >= 0],
+                         'translations': [self.tg_vocab[ind]
+                                          for ind in trans_row if ind >= 0]}
+                        for near_row, trans_row, ok in zip(
+                            near_inds[offset:offset + len(query.rows)],
+                            trans_inds[offset:offset + len(query.rows)],
+                            translated[offset:offset + len(query.rows)])
+                        if ok]
+                    offset += len(query.rows)
+            except Exception as e:
+                logging.exception('batch of {} senses failed'.format(size))
+                for query in queries:
+                    query.error = e
+            for query in queries:
+                query.done.set()
+
+    def translate(self, hwd):
+        """The neighbors and translations of each sense of hwd."""
+        result = self.cache.get(hwd)
+        if result is None:
+            i = self.sr_senses.index(hwd)
+            if i < 0:
+                return None
+            offsets = self.sr_senses.offsets
+            query = Query(numpy.arange(offsets[i], offsets[i + 1]))
+            self.queue.put(query)
+            query.done.wait()
+            if query.error:
+                raise query.error
+            result = query.result
+            self.cache.put(hwd, result)
+        return result
+
+    def main(self):
+        server = ThreadingHTTPServer((self.args.host, self.args.port),
+                                     TranslationHandler)
+        server.translator = self
+        logging.info('serving on {}:{}'.format(self.args.host,
+                                               self.args.port))
+        server.serve_forever()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/translate':
+            self.send_error(404, 'only /translate?word=... is served')
+            return
+        words = parse_qs(url.query).get('word', [])
+        try:
+            body = json.dumps({word: self.server.translator.translate(word)
+                               for word in words})
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        logging.debug(format_ % args)
+
+
+if __name__ == "__main__":
+    TranslationServer().main()
@@ -0,0 +1,135 @@
+#coding=utf-8
+"""
+Reads and writes embeddings in the binary format of the original word2vec.
+
+The file starts with a "vocab_size dim" text line, followed by one record
+per row: the word, a space, dim little-endian float32 numbers and a newline.
+In the mse variant, the senses of a word are consecutive rows with the same
+word; since the converters disagree on whether the header counts words or
+rows, the reader reads rows until the end of the file.
+
+The vectors are written and read in bulk, without formatting or parsing any
+numbers. The module works in Python 2 and 3 (jiweil_sense_to_w2v.py is a
+Python 3 script).
+"""
+
+import mmap
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+FLOAT = numpy.dtype('<f4')
+# the row count of a placeholder header is padded to this many characters
+HEADER_WIDTH = 20
+
+
+def to_bytes(word):
+    return word if isinstance(word, bytes) else word.encode('utf-8')
+
+
+def to_str(word):
+    return word if isinstance(word, str) else word.decode('utf-8')
+
+
+class W2VBinaryWriter():
+    """
+    Writes rows into a binary file with the given header. If vocab_size is
+    None, the header is a fixed-width placeholder that finish overwrites
+    with the number of rows written (outfile must be seekable then).
+    """
+    def __init__(self, outfile, vocab_size, dim):
+        self.outfile = outfile
+        self.dim = dim
+        self.rows = 0
+        self.header_pos = None
+        if vocab_size is None:
+            self.header_pos = outfile.tell()
+        self.write_header(vocab_size or 0)
+
+    def write_header(self, vocab_size):
+        count = str(vocab_size)
+        if self.header_pos is not None:
+            count = count.rjust(HEADER_WIDTH)
+        self.outfile.write('{} {}\n'.format(count, self.dim).encode('ascii'))
+
+    def finish(self):
+        """Fills in the placeholder header; returns the number of rows."""
+        if self.header_pos is not None:
+            end = self.outfile.tell()
+            self.outfile.seek(self.header_pos)
+            self.write_header(self.rows)
+            self.outfile.seek(end)
+        return self.rows
+
+    def write(self, word, vec):
+        self.write_rows([word], numpy.asarray(vec).reshape(1, -1))
+
+    def write_rows(self, words, vecs):
+        vecs = numpy.ascontiguousarray(vecs, dtype=FLOAT)
+        if vecs.shape != (len(words), self.dim):
+            raise ValueError('expected {} rows of dimension {}, got {}'.format(
+                len(words), self.dim, vecs.shape))
+        self.rows += len(words)
+        data = vecs.tobytes()
+        row_bytes = self.dim * FLOAT.itemsize
+        self.outfile.write(b''.join(
+            to_bytes(word) + b' ' + data[i * row_bytes:(i + 1) * row_bytes] +
+            b'\n' for i, word in enumerate(words)))
+
+
+def write_w2v_binary(filen, words, vecs, vocab_size=None):
+    """
+    Writes the rows of vecs with the words; the header counts the rows
+    unless vocab_size is given.
+    """
+    with open(filen, 'wb') as outfile:
+        writer = W2VBinaryWriter(
+            outfile, len(words) if vocab_size is None else vocab_size,
+            vecs.shape[1])
+        writer.write_rows(words, vecs)
+
+
+def read_w2v_binary(filen, vectors=True):
+    """
+    Returns the words (one per row) and the float32 rows of a binary file;
+    the rows are None if vectors is False.
+    """
+    with open(filen, 'rb') as infile:
+        header = infile.readline().split()
+        dim = int(header[1])
+        start = infile.tell()
+        infile.seek(0, 2)
+        if infile.tell() == start:
+            empty = numpy.zeros((0, dim), dtype='float32')
+            return [], empty if vectors else None
+        data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        row_bytes = dim * FLOAT.itemsize
+        words, offsets = [], []
+        pos, size = start, len(data)
+        while pos < size:
+            # word2vec writes a newline after each vector; some tools do not
+            while pos < size and data[pos:pos + 1] in (b'\n', b' '):
+                pos += 1
+            if pos == size:
+                break
+            space = data.find(b' ', pos)
+            if space < 0 or space + 1 + row_bytes > size:
+                raise ValueError('truncated record at byte {} of {}'.format(
+                    pos, filen))
+            words.append(to_str(data[pos:space]))
+            offsets.append(space + 1)
+            pos = space + 1 + row_bytes
+        if not vectors:
+            return words, None
+        # every row_bytes long slice of the file is a row of the window, so
+        # the records are gathered with one fancy index by their offsets
+        raw = numpy.frombuffer(data, dtype='uint8')
+        window = as_strided(
+            raw, (max(len(raw) - row_bytes + 1, 0), row_bytes), (1, 1))
+        rows = window[numpy.array(offsets, dtype='int64')]
+        # mmap.close fails while an array still exports its buffer
+        del raw, window
+        return words, rows.view(FLOAT)
+    finally:
+        data.close()